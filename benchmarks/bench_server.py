@@ -0,0 +1,156 @@
+"""Latency / throughput benchmark of keplerserver against the simulated module.
+
+Starts the server in a subprocess with KEPLERSERVER_SIM=1 and drives each
+scenario from N concurrent keep-alive clients for a fixed duration:
+
+  python benchmarks/bench_server.py --clients 1,4,8 --duration 5
+
+Per-call serial latency of the simulated module is set with --sim-latency.
+With --replay the module is served from a recorded RPC trace instead (see
+keplerserver.trace), at the recorded call latencies times --replay-timing.
+
+The "(sim pipelined)" batch figure is simulator-only: the simulated link
+answers a batch in one round-trip, KeplerRPC has no batch framing and on
+the module (as on --replay) every request of a batch is its own round-trip.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import msgpack
+import msgpack_numpy
+import numpy as np
+
+msgpack_numpy.patch()
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CAPTURE_LENGTHS = [1024, 16384, 131072]
+PILOT_LENGTH = 4096
+BATCH_LENGTH = 20
+
+def _free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def start_server(port, sim_latency, workdir, verbose=False, replay=None, replay_timing=1.):
+  env = dict(os.environ)
+  env.update({'KEPLERSERVER_SIM': '1', 'KEPLERSERVER_SIM_LATENCY': str(sim_latency),
+              'KEPLERSERVER_LISTEN': '127.0.0.1:{}'.format(port), 'KEPLERSERVER_LOG_LEVEL': 'WARNING',
+              'PYTHONPATH': ROOT + os.pathsep + env.get('PYTHONPATH', '')})
+  if replay:
+    env.update({'KEPLERSERVER_REPLAY': os.path.abspath(replay), 'KEPLERSERVER_REPLAY_TIMING': str(replay_timing)})
+  # waitress warns about its task queue on every saturated run, keep the table readable
+  out = None if verbose else subprocess.DEVNULL
+  proc = subprocess.Popen([sys.executable, '-c', 'import keplerserver; keplerserver.main()'], cwd=workdir, env=env, stdout=out, stderr=out)
+  deadline = time.monotonic() + 60.
+  while time.monotonic() < deadline:
+    if proc.poll() is not None:
+      raise RuntimeError('server exited with {}'.format(proc.returncode))
+    try:
+      conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1.)
+      conn.request('GET', '/readyz')
+      if conn.getresponse().status == 200:
+        conn.close()
+        return proc
+    except OSError:
+      time.sleep(0.2)
+  proc.kill()
+  raise RuntimeError('server did not come up')
+
+def scenarios(replay=False):
+  """name -> fn(i) returning (method, path, body, headers) for the i-th request of a client."""
+  pilot = msgpack.packb(np.exp(1j * np.linspace(0, 2 * np.pi, PILOT_LENGTH)).astype('complex64'), use_bin_type=True)
+  form_headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+  result = {
+    'GET /': lambda i: ('GET', '/', None, {}),
+    'GET /_fetch_status': lambda i: ('GET', '/_fetch_status', None, {}),
+  }
+  for n in CAPTURE_LENGTHS:
+    result['get_capture {} legacy'.format(n)] = lambda i, n=n: ('GET', '/api/kepler/get_capture,0,{},0'.format(n), None, {})
+    result['get_capture {} raw'.format(n)] = lambda i, n=n: ('GET', '/api/kepler/get_capture,0,{},0,raw'.format(n), None, {})
+  result['load_pilot {}'.format(PILOT_LENGTH)] = lambda i: ('POST', '/api/kepler/load_pilot', pilot, {'Content-Type': 'application/x-msgpack'})
+  result['change_config'] = lambda i: ('POST', '/', urllib.parse.urlencode({'target_gain': 60 + i % 2}), form_headers)
+  # uncached getters, pipelined into one round-trip only by the simulated link,
+  # not a figure for the module
+  batch = json.dumps([{'method': m} for m in ['read_powers', 'accum_status', 'gain', 'secs_alive', 'tdd_sync_status'] * (BATCH_LENGTH // 5)])
+  result['batch {}{}'.format(BATCH_LENGTH, '' if replay else ' (sim pipelined)')] = lambda i: ('POST', '/api/kepler/batch', batch, {'Content-Type': 'application/json'})
+  return result
+
+def run_scenario(port, make_request, clients, duration):
+  latencies = [[] for _ in range(clients)]
+  errors = [0] * clients
+  stop_at = time.monotonic() + duration
+
+  def client(k):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60.)
+    i = 0
+    while time.monotonic() < stop_at:
+      method, path, body, headers = make_request(i)
+      t0 = time.perf_counter()
+      try:
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status >= 400:
+          errors[k] += 1
+      except (OSError, http.client.HTTPException):
+        errors[k] += 1
+        conn.close()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60.)
+      latencies[k].append(time.perf_counter() - t0)
+      i += 1
+    conn.close()
+
+  t0 = time.perf_counter()
+  threads = [threading.Thread(target=client, args=(k,)) for k in range(clients)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.perf_counter() - t0
+  lat = np.concatenate([np.asarray(l) for l in latencies]) if any(latencies) else np.zeros(1)
+  return {'requests': len(lat), 'errors': sum(errors), 'rps': len(lat) / elapsed,
+          'p50': np.percentile(lat, 50), 'p95': np.percentile(lat, 95),
+          'p99': np.percentile(lat, 99), 'max': lat.max()}
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--clients', default='1,4,8', help='comma separated concurrent client counts')
+  parser.add_argument('--duration', type=float, default=5., help='seconds per scenario and client count')
+  parser.add_argument('--sim-latency', type=float, default=0.005, help='simulated per-call serial latency (s)')
+  parser.add_argument('--replay', help='serve the module from this RPC trace instead of the simulator')
+  parser.add_argument('--replay-timing', type=float, default=1., help='scale of the recorded call latencies on replay')
+  parser.add_argument('--verbose', action='store_true', help='show the server log')
+  parser.add_argument('--only', default='', help='run scenarios whose name contains this string')
+  args = parser.parse_args()
+
+  port = _free_port()
+  with tempfile.TemporaryDirectory() as workdir:
+    proc = start_server(port, args.sim_latency, workdir, args.verbose, args.replay, args.replay_timing)
+    try:
+      print('{:<28} {:>7} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+        'scenario', 'clients', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+      for name, make_request in scenarios(args.replay is not None).items():
+        if args.only not in name:
+          continue
+        for clients in [int(c) for c in args.clients.split(',')]:
+          r = run_scenario(port, make_request, clients, args.duration)
+          print('{:<28} {:>7} {:>8.1f} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            name, clients, r['rps'], r['errors'], r['p50'] * 1e3, r['p95'] * 1e3, r['p99'] * 1e3, r['max'] * 1e3))
+          sys.stdout.flush()
+    finally:
+      proc.terminate()
+      proc.wait()
+
+if __name__ == '__main__':
+  main()
@@ -1,32 +1,148 @@
-from flask import Flask, render_template, request, Response, jsonify, url_for
+from flask import Flask, Blueprint, render_template, request, Response, jsonify, url_for, g, abort
 import msgpack
 import msgpack_numpy
 import numpy as np
-import RPi.GPIO as GPIO
 import time
 import datetime
-import shlex
+import json
+import base64
+import threading
+import logging
+import os
+import signal
 from waitress import serve
 
 msgpack_numpy.patch()
 
-from .kepler import Kepler
-from .repeater import Repeater
+from .devices import Device, DeviceRegistry, load_device_configs
+from .kepler import CAPTURE_FORMATS
+from .serialworker import SerialTimeout
+from .jobs import JobManager, JobConflict, gpio_pulse
+from .history import TELEMETRY_LAYOUT
+from .journal import JournalTooLarge
+from .fastsample import FAST_LAYOUT
+from .status import STATUS_LAYOUT, status_dict
+from .commands import parse_command, convert_args
+from .analysis import analyze_capture, boxcal_conversions, path_offsets
+from .trace import ReplayKeplerRPC
+from . import metrics
+
+# KEPLERSERVER_SIM=1 runs against the simulated module and GPIO stub, no hardware needed
+simulate = os.environ.get('KEPLERSERVER_SIM', '0') not in ['', '0']
+# KEPLERSERVER_REPLAY=<trace> serves the module from a recorded RPC trace, {id}
+# in the path is replaced by the device id; KEPLERSERVER_REPLAY_TIMING scales
+# the recorded call latencies (0 replays as fast as possible)
+replay = os.environ.get('KEPLERSERVER_REPLAY')
+replay_timing = float(os.environ.get('KEPLERSERVER_REPLAY_TIMING', '1'))
+if simulate or replay:
+    from .sim import SimKeplerRPC, sim_gpio as GPIO
+else:
+    import RPi.GPIO as GPIO
+
+# DEBUG logs every RPC call
+log_level = os.environ.get('KEPLERSERVER_LOG_LEVEL', 'INFO')
+logging.basicConfig(level=log_level, format='%(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 
 port_kepler = "/dev/ttyAMA1"
+listen = os.environ.get('KEPLERSERVER_LISTEN', '0.0.0.0:5000')
+# simulated per-call serial latency (s)
+sim_latency = float(os.environ.get('KEPLERSERVER_SIM_LATENCY', '0.005'))
 gpio_ue = 24
 gpio_kepler = 10
+# JSON list of the served units, see devices.load_device_configs; without it
+# the single unit above (port_kepler, gpio_kepler, gpio_ue) is served
+devices_config = os.environ.get('KEPLERSERVER_DEVICES', '/etc/keplerserver/devices.json')
+# status sampler period (s) and how many samples between config re-reads
+status_interval = 1.0
+config_refresh_every = 10
+# module heartbeat period and timeout (s), see watchdog.Watchdog
+heartbeat_interval = 2.0
+heartbeat_timeout = 2.0
+# fast power sampling sessions (see fastsample.FastSampler): longest session
+# and how long a client lease lives without being renewed (s)
+fast_sample_max_secs = 120.
+fast_sample_lease_secs = 10.
+# KEPLERSERVER_TRACE=<file> records every RPC call from startup ({id} as for
+# replays), /api/trace/start records to a new file in trace_dir
+trace_path = os.environ.get('KEPLERSERVER_TRACE')
+trace_dir = os.environ.get('KEPLERSERVER_TRACE_DIR', '.kepler_traces')
+# serial access is arbitrated by Kepler's worker thread, so the HTTP layer can run several threads
+http_threads = 4
+# status push streams each hold a waitress thread, keep some free for regular requests
+status_stream_limit = max(1, http_threads // 2)
+status_stream_max_secs = 60.
+status_stream_keepalive_secs = 15.
+# on-disk telemetry journal, one record per status sample
+telemetry_journal_dir = '.kepler_telemetry'
+telemetry_segment_records = 86400
+telemetry_max_segments = 8
+# most journal records returned by one /api/journal request
+journal_max_records = 10000
+# most commands accepted by one /api/kepler/batch request
+kepler_batch_limit = 1000
+# chunk size for streamed capture responses
+capture_chunk_bytes = 64 * 1024
 
 GPIO.setmode(GPIO.BCM)
-GPIO.setup(gpio_kepler, GPIO.OUT)
 
-@app.route("/", methods =["GET", "POST"])
-@app.route("/home", methods =["GET", "POST"])
-def index():
-    _rpt.check_alive()
+@app.before_request
+def metrics_start():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def metrics_observe(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.http_latency.observe(time.perf_counter() - g.request_start, route)
+    metrics.http_requests.inc(route, request.method, str(response.status_code))
+    return response
+
+@app.teardown_request
+def metrics_exception(exc):
+    # unhandled exceptions skip after_request
+    if exc is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.http_latency.observe(time.perf_counter() - g.request_start, route)
+        metrics.http_requests.inc(route, request.method, '500')
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+# device-backed routes, served for the default unit at / and for every unit at /dev/<dev_id>/
+device_bp = Blueprint('device', __name__)
+
+_devices = DeviceRegistry()
+# flashing and resets run as background jobs, polled at /api/jobs/<job_id>
+_jobs = JobManager()
 
+@device_bp.url_value_preprocessor
+def select_device(endpoint, values):
+    dev_id = values.pop('dev_id', None) if values else None
+    g.dev = _devices.default if dev_id is None else _devices.get(dev_id)
+
+@device_bp.url_defaults
+def add_device_id(endpoint, values):
+    # url_for('.x') inside a /dev/<dev_id> page stays on that unit
+    if 'dev_id' not in values and app.url_map.is_endpoint_expecting(endpoint, 'dev_id'):
+        values['dev_id'] = g.dev.id
+
+@device_bp.before_request
+def require_ready():
+    if g.dev is None:
+        abort(404)
+    # startup runs in stages while HTTP is already served, answer 503 until the unit is up
+    if not g.dev.ready.is_set():
+        resp = jsonify({'device': g.dev.id, 'stage': g.dev.startup['stage'], 'error': g.dev.startup['error']})
+        resp.status_code = 503
+        resp.headers['Retry-After'] = '1'
+        return resp
+
+@device_bp.route("/", methods =["GET", "POST"])
+@device_bp.route("/home", methods =["GET", "POST"])
+def index():
     if request.method == "POST":
         output = request.form.to_dict()
         for k, v in output.items():
@@ -36,115 +152,504 @@ def index():
             output[k] = v
           else:
             output[k] = int(v)
-        _rpt.change_config(output)
+        with g.dev.rpt.lock:
+            g.dev.rpt.change_config(output)
+        snap = g.dev.sampler.refresh(config=True)
+    else:
+        snap = g.dev.sampler.snapshot()
 
-    _rpt.fetch_kepler_status()
-    kstat_h, kstat_v = _rpt.get_kepler_status()
+    return render_template("main.html", kstat_h=snap.kstat_h, kstat_v=snap.kstat, tstat_h=snap.tstat_h, tstat_v=snap.tstat, config=snap.config, current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
 
-    _rpt.fetch_tdd_status()
-    tstat_h, tstat_v = _rpt.get_tdd_status()
+@device_bp.route('/_fetch_status', methods = ['GET'])
+def fetch_status():
+    snap = g.dev.sampler.snapshot()
+    return jsonify({"kstat": dict(snap.kstat), "tstat": dict(snap.tstat), "timestamp": snap.timestamp})
 
-    _rpt.fetch_curconfig()
-    config = _rpt.get_config()
 
-    return render_template("main.html", kstat_h=kstat_h, kstat_v=kstat_v, tstat_h=tstat_h, tstat_v=tstat_v, config=config, current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+@device_bp.route('/api/config/journal')
+def config_journal():
+    """Recent config changes, oldest first, each {t, changes: {key: [old, new]}}."""
+    with g.dev.rpt.lock:
+        return jsonify(g.dev.rpt.config_journal())
 
-@app.route('/_fetch_status', methods = ['GET'])
-def fetch_status():
-    _rpt.check_alive()
-    _rpt.fetch_kepler_status()
-    kstat_h, kstat_v = _rpt.get_kepler_status()
-    _rpt.fetch_tdd_status()
-    tstat_h, tstat_v = _rpt.get_tdd_status()
-    return jsonify({"kstat": kstat_v, "tstat":tstat_v})
+@device_bp.route('/api/config/rollback', methods=['POST'])
+def config_rollback():
+    """Undo the last ?steps= config changes on the module."""
+    steps = request.args.get('steps', 1, type=int)
+    try:
+        with g.dev.rpt.lock:
+            g.dev.rpt.rollback_config(steps)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/html')
+    snap = g.dev.sampler.refresh(config=True)
+    return jsonify(dict(snap.config))
 
+@device_bp.route('/api/status')
+def status_vector():
+    """Numeric status of the latest snapshot, msgpack {layout, status: float64 vector} or JSON by field name."""
+    snap = g.dev.sampler.snapshot()
+    if request.args.get('format') == 'msgpack':
+        data = {'seq': snap.seq, 'timestamp': snap.timestamp, 'layout': STATUS_LAYOUT, 'status': snap.status}
+        return Response(msgpack.packb(data, use_bin_type=True), mimetype='application/x-msgpack')
+    return jsonify({'seq': snap.seq, 'timestamp': snap.timestamp, 'status': status_dict(snap.status)})
+
+_status_stream_slots = threading.BoundedSemaphore(status_stream_limit)
+
+def status_event(snap, prev=None):
+    """Format a snapshot as a server-sent event, only fields changed since prev."""
+    data = {"timestamp": snap.timestamp}
+    for key in ['kstat', 'tstat']:
+        cur = getattr(snap, key)
+        old = {} if prev is None else getattr(prev, key)
+        changed = {k: v for k, v in cur.items() if old.get(k) != v}
+        if changed:
+            data[key] = changed
+    if prev is not None and len(data) == 1:
+        return None
+    return 'data: {}\n\n'.format(json.dumps(data))
+
+@device_bp.route('/api/stream/status')
+def stream_status():
+    # every open stream pins a waitress thread, refuse once the limit is
+    # reached and let the page fall back to polling /_fetch_status
+    if not _status_stream_slots.acquire(blocking=False):
+        return Response("too many status streams", status=503, mimetype='text/html')
+    sampler = g.dev.sampler
+    def generate():
+        prev = sampler.snapshot()
+        yield 'retry: 1000\n' + status_event(prev)
+        # streams are recycled so a thread is never held indefinitely, EventSource reconnects
+        deadline = time.monotonic() + status_stream_max_secs
+        while time.monotonic() < deadline:
+            snap = sampler.wait_newer(prev.seq, timeout=min(status_stream_keepalive_secs, max(0., deadline - time.monotonic())))
+            if snap.seq == prev.seq:
+                yield ': keepalive\n\n'
+                continue
+            event = status_event(snap, prev)
+            prev = snap
+            if event is not None:
+                yield event
+    resp = Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    resp.call_on_close(_status_stream_slots.release)
+    return resp
+
+def _tolists(obj):
+    """Numpy arrays in (nested dicts of) query results -> lists, for jsonify."""
+    if isinstance(obj, dict):
+        return {k: _tolists(v) for k, v in obj.items()}
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return obj
+
+@device_bp.route('/api/history')
+def history():
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    points = request.args.get('points', type=int)
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else None
+    try:
+        hist = g.dev.rpt.get_history(start, end, points, fields)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/html')
+    if request.args.get('format') == 'msgpack':
+        return Response(msgpack.packb(hist, use_bin_type=True), mimetype='application/x-msgpack')
+    return jsonify(_tolists(hist))
+
+@device_bp.route('/api/journal')
+def journal():
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    try:
+        records = g.dev.rpt.get_journal(start, end, journal_max_records)
+    except JournalTooLarge as e:
+        return Response("{}, narrow start/end".format(e), status=413, mimetype='text/html')
+    if records is None:
+        return Response("telemetry journal disabled", status=404, mimetype='text/html')
+    data = {'t': records['t'], 'flags': records['flags'], 'data': records['data'], 'layout': TELEMETRY_LAYOUT}
+    if request.args.get('format') == 'msgpack':
+        return Response(msgpack.packb(data, use_bin_type=True), mimetype='application/x-msgpack')
+    return jsonify(_tolists(data))
+
+@device_bp.route('/api/fast/subscribe', methods=['POST'])
+def fast_subscribe():
+    """Lease on high-rate read_powers/accum_status sampling, starts a session unless one is running."""
+    try:
+        lease = g.dev.fast.subscribe(rate=request.args.get('rate', 20., type=float),
+                                     duration=request.args.get('duration', 30., type=float))
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/html')
+    return jsonify(lease)
+
+@device_bp.route('/api/fast/unsubscribe', methods=['POST'])
+def fast_unsubscribe():
+    g.dev.fast.unsubscribe(request.args.get('lease', ''))
+    return Response('OK', mimetype='text/html')
+
+@device_bp.route('/api/fast/envelope')
+def fast_envelope():
+    """min/max/last envelopes of the fast samples, reading with a lease renews it."""
+    lease = request.args.get('lease')
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else None
+    try:
+        env = g.dev.fast.envelope(request.args.get('width', type=int), fields, request.args.get('start', type=float))
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/html')
+    env['leased'] = g.dev.fast.renew(lease) if lease else False
+    if request.args.get('format') == 'msgpack':
+        env['layout'] = FAST_LAYOUT
+        return Response(msgpack.packb(env, use_bin_type=True), mimetype='application/x-msgpack')
+    return jsonify(_tolists(env))
 
-@app.route('/api/reset_ue')
+def submit_job(kind, fn, key):
+    """Start a background job for the current unit, 202 with the job and its polling URL."""
+    try:
+        job = _jobs.submit(kind, fn, key=key, device=g.dev.id)
+    except JobConflict as e:
+        return Response(str(e), status=409, mimetype='text/html')
+    resp = jsonify(job.to_dict(tail=0))
+    resp.status_code = 202
+    resp.headers['Location'] = url_for('job_status', job_id=job.id)
+    return resp
+
+@device_bp.route('/api/reset_ue')
 def reset_ue_gpio():
-    GPIO.setup(gpio_ue, GPIO.OUT)
-    GPIO.output(gpio_ue, False)
-    time.sleep(1)
-    GPIO.output(gpio_ue, True)
-    time.sleep(1)
-    return Response("RESET SUCCESS", mimetype='text/html')
-
-@app.route('/api/reset_kepler')
+    pin = g.dev.gpio_ue
+    if pin is None:
+        return Response("no UE reset line on {}".format(g.dev.id), status=404, mimetype='text/html')
+    return submit_job('reset_ue', lambda job: gpio_pulse(GPIO, pin, job.log), ('gpio', pin))
+
+@device_bp.route('/api/reset_kepler')
 def reset_kepler_gpio():
-    GPIO.setup(gpio_kepler, GPIO.OUT)
-    GPIO.output(gpio_kepler, False)
-    time.sleep(1)
-    GPIO.output(gpio_kepler, True)
-    time.sleep(1)
-    return Response("RESET SUCCESS", mimetype='text/html')
+    pin = g.dev.gpio_reset
+    if pin is None:
+        return Response("no reset line on {}".format(g.dev.id), status=404, mimetype='text/html')
+    return submit_job('reset_kepler', lambda job: gpio_pulse(GPIO, pin, job.log), ('gpio', pin))
 
 
-@app.route('/api/kepler/load_pilot', methods=['POST'])
+@device_bp.route('/api/kepler/load_pilot', methods=['POST'])
 def kepler_load_pilot():
     data = request.get_data()
-    print('load_pilot: received {} bytes'.format(len(data)))
+    logger.info('load_pilot: received %d bytes', len(data))
     obj = msgpack.unpackb(data, use_list=True, raw=False)
     tx_wfm = obj.astype('complex64')
-    ret = _kepler.load_pilot(tx_wfm)
+    ret = g.dev.kepler.load_pilot(tx_wfm)
     return Response(str(ret), mimetype='text/html')
 
-@app.route('/api/kepler/canxfir_load,<tddstr>', methods=['POST'])
+@device_bp.route('/api/kepler/canxfir_load,<tddstr>', methods=['POST'])
 def kepler_canxfir_load(tddstr):
     tdd = int(tddstr)
-    print('canxfir_load, tdd {}'.format(tdd))
+    logger.info('canxfir_load, tdd %d', tdd)
     data = request.get_data()
     obj = msgpack.unpackb(data, use_list=True, raw=False)
     tunerdata = obj.astype('float32')
 
-    ret = _kepler.canxfir_load(tdd, tunerdata)
+    ret = g.dev.kepler.canxfir_load(tdd, tunerdata)
     return Response(str(ret), mimetype='text/html')
 
-@app.route('/api/kepler/<command>')
+def raw_upload(dtype):
+    """Return the request body as a memoryview for the binary upload routes, or an error Response."""
+    if request.mimetype != 'application/octet-stream':
+        return Response("expected application/octet-stream", status=415, mimetype='text/html')
+    if request.args.get('dtype', dtype) != dtype:
+        return Response("expected dtype {}".format(dtype), status=400, mimetype='text/html')
+    data = memoryview(request.get_data(cache=False))
+    if len(data) == 0 or len(data) % 4 != 0:
+        return Response("body must be a non-empty multiple of 4 bytes", status=400, mimetype='text/html')
+    return data
+
+@device_bp.route('/api/kepler/load_pilot_raw', methods=['POST'])
+def kepler_load_pilot_raw():
+    data = raw_upload('int16')
+    if isinstance(data, Response):
+        return data
+    logger.info('load_pilot_raw: received %d bytes', len(data))
+    ret = g.dev.kepler.load_pilot_raw(data)
+    return Response(str(ret), mimetype='text/html')
+
+@device_bp.route('/api/kepler/canxfir_load_raw,<tddstr>', methods=['POST'])
+def kepler_canxfir_load_raw(tddstr):
+    tdd = int(tddstr)
+    data = raw_upload('float32')
+    if isinstance(data, Response):
+        return data
+    logger.info('canxfir_load_raw, tdd %d', tdd)
+    ret = g.dev.kepler.canxfir_load_raw(tdd, data)
+    return Response(str(ret), mimetype='text/html')
+
+def stream_capture(buf, dtype, headers=None):
+    """Stream a capture buffer in chunks, length and dtype go in the response headers."""
+    mv = memoryview(buf).cast('B')
+    def generate():
+        for i in range(0, len(mv), capture_chunk_bytes):
+            yield mv[i:i+capture_chunk_bytes].tobytes()
+    headers = dict(headers or {})
+    headers.update({'Content-Length': str(len(mv)),
+                    'X-Capture-Dtype': dtype,
+                    'X-Capture-Length': str(len(mv) // (4 if dtype == 'int16' else 8))})
+    return Response(generate(), mimetype='application/octet-stream', headers=headers)
+
+@device_bp.route('/api/kepler/capture_analyze')
+def kepler_capture_analyze():
+    """Capture and reduce on the server, returns the PSD and power/IQ summary instead of the samples."""
+    args = request.args
+    try:
+        group = args.get('group', 0, type=int)
+        length = args.get('length', 16384, type=int)
+        triggered = args.get('triggered', 0, type=int)
+        channels = args.get('channels', 1, type=int)
+        paths = args.get('paths')
+        paths = paths.split(',') if paths else None
+        offsets = None
+        if paths is not None:
+            offsets = path_offsets(paths, boxcal_conversions(*g.dev.kepler.call_many(
+                [('get_boxcal_data',), ('dl_atten',), ('ul_atten',)])))
+        capture = g.dev.kepler.get_capture(group, length, triggered, 'complex64')
+        result = analyze_capture(capture, channels=channels, nfft=args.get('nfft', 1024, type=int),
+                                 overlap=args.get('overlap', 0.5, type=float), averages=args.get('averages', type=int),
+                                 fs=args.get('fs', type=float), offsets=offsets)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/html')
+    if paths is not None:
+        result['paths'] = paths
+    if args.get('format') == 'msgpack':
+        return Response(msgpack.packb(result, use_bin_type=True), mimetype='application/x-msgpack')
+    return Response(json.dumps(result, default=json_default), mimetype='application/json')
+
+@device_bp.route('/api/kepler/get_captures')
+def kepler_get_captures():
+    """Several capture groups in one request, ?captures=group:length:triggered,...
+
+    legacy format returns msgpack {data, offsets, captures}; raw and complex64
+    stream the concatenated buffer with the offsets in X-Capture-Offsets.
+    """
+    fmt = request.args.get('format', 'legacy')
+    try:
+        captures = [tuple(int(v) for v in item.split(':')) for item in request.args.get('captures', '').split(',') if item]
+        if any(len(c) != 3 for c in captures):
+            raise ValueError('captures are group:length:triggered')
+        data, offsets = g.dev.kepler.get_captures(captures, fmt)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/html')
+    logger.info('got %d captures, %d samples, format %s', len(captures), offsets[-1], fmt)
+    if fmt == 'legacy':
+        return Response(msgpack.packb({'data': data, 'offsets': offsets, 'captures': captures}, use_bin_type=True),
+                        mimetype='application/x-msgpack')
+    return stream_capture(data, 'int16' if fmt == 'raw' else 'complex64',
+                          {'X-Capture-Offsets': ','.join(str(o) for o in offsets),
+                           'X-Capture-Groups': ','.join(str(c[0]) for c in captures)})
+
+@device_bp.route('/api/kepler/<command>')
 def kepler_dispatch(command):
     command = command.lower().strip().lstrip(':')
     if command.startswith('get_capture,'):
-        group = int(command.split(',')[-3])
-        length = int(command.split(',')[-2])
-        triggered = int(command.split(',')[-1])
-        print('got capture group {} len {} triggered {}'.format(group, length, triggered))
-        capture = _kepler.get_capture(group, length, triggered)
-        return Response(msgpack.packb(capture, use_bin_type=True), mimetype='application/x-msgpack')
+        params = command.split(',')[1:]
+        try:
+            group = int(params[0])
+            length = int(params[1])
+            triggered = int(params[2])
+        except (IndexError, ValueError):
+            return Response("expected get_capture,group,length,triggered[,format]", status=400, mimetype='text/html')
+        fmt = params[3] if len(params) > 3 else request.args.get('format', 'legacy')
+        if fmt not in CAPTURE_FORMATS:
+            return Response("unknown capture format {}, one of {}".format(fmt, ', '.join(CAPTURE_FORMATS)),
+                            status=400, mimetype='text/html')
+        logger.info('got capture group %d len %d triggered %d format %s', group, length, triggered, fmt)
+        capture = g.dev.kepler.get_capture(group, length, triggered, fmt)
+        if fmt == 'legacy':
+            return Response(msgpack.packb(capture, use_bin_type=True), mimetype='application/x-msgpack')
+        return stream_capture(capture, 'int16' if fmt == 'raw' else 'complex64')
     elif command.startswith('program_mcu'):
         filename = command.split(',')[-1]
-        ret = _kepler.program_mcu(filename)
-        return Response(str(ret), mimetype='text/html')
+        kepler = g.dev.kepler
+        return submit_job('program_mcu', lambda job: kepler.program_mcu(filename, job), ('serial', g.dev.id))
     elif command == 'reset_mcu':
-        ret = _kepler.reset_mcu()
-        return Response(str(ret), mimetype='text/html')
+        kepler = g.dev.kepler
+        return submit_job('reset_mcu', lambda job: kepler.reset_mcu(job), ('serial', g.dev.id))
+    elif command == 'cache_stats':
+        return jsonify(g.dev.kepler.cache_stats())
     elif command.startswith('canxfir_get'):
         tdd = int(command.split(',')[-1])
-        data = _kepler.canxfir_get(tdd)
-        return Response(msgpack.packb(data, use_bin_type=True), mimetype='application/x-msgpack')
+        refresh = request.args.get('refresh', 0, type=int) != 0
+        etag = g.dev.kepler.canxfir_etag(tdd)
+        if etag is not None and not refresh and request.if_none_match.contains(etag):
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            return resp
+        data, version, etag = g.dev.kepler.canxfir_get_versioned(tdd, refresh=refresh)
+        resp = Response(msgpack.packb(data, use_bin_type=True), mimetype='application/x-msgpack')
+        resp.set_etag(etag)
+        resp.headers['X-Canxfir-Version'] = str(version)
+        return resp
     else:
-        aa = shlex.shlex(command)
-        aa.whitespace += ','
-        aa.whitespace_split = True
-        cmd_list = list(aa)
-        method = cmd_list[0]
-        arglist = cmd_list[1:]
-        args = [k[1:-1] if '"' in k else (float(k) if '.' in k else int(k)) for k in arglist]
-        print(command, args)
-        ret = _kepler.call(method, *args)
+        try:
+            method, args = parse_command(command)
+        except ValueError as e:
+            return Response(str(e), status=400, mimetype='text/html')
+        logger.debug('%s %s', command, args)
+        ret = g.dev.kepler.call(method, *args)
         return Response(str(ret), mimetype='text/html')
 
-@app.route('/check_alive')
+def json_default(obj):
+    if isinstance(obj, np.ndarray) or isinstance(obj, np.generic):
+        return obj.tolist()
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(obj)).decode('ascii')
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+@device_bp.route('/api/kepler/batch', methods=['POST'])
+def kepler_batch():
+    use_msgpack = request.mimetype in ['application/x-msgpack', 'application/msgpack']
+    try:
+        if use_msgpack:
+            items = msgpack.unpackb(request.get_data(), raw=False)
+        else:
+            items = json.loads(request.get_data())
+        if not isinstance(items, list) or len(items) > kepler_batch_limit:
+            raise ValueError('expected a list of at most {} commands'.format(kepler_batch_limit))
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/html')
+
+    results = [None] * len(items)
+    calls = []
+    index = []
+    for i, item in enumerate(items):
+        try:
+            method = str(item['method']).lower()
+            args = convert_args(method, item.get('args', []))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            results[i] = {'ok': False, 'error': 'bad command: {}'.format(e)}
+            continue
+        calls.append((method, args))
+        index.append(i)
+    try:
+        replies = g.dev.kepler.call_many(calls, return_exceptions=True)
+    except SerialTimeout as e:
+        # requests already on the link still complete, their replies are lost
+        return Response("batch of {} commands: {}".format(len(calls), e), status=504, mimetype='text/html')
+    for i, ret in zip(index, replies):
+        if isinstance(ret, Exception):
+            results[i] = {'ok': False, 'error': str(ret)}
+        else:
+            results[i] = {'ok': True, 'result': ret}
+
+    if use_msgpack:
+        return Response(msgpack.packb(results, use_bin_type=True), mimetype='application/x-msgpack')
+    return Response(json.dumps(results, default=json_default), mimetype='application/json')
+
+@device_bp.route('/check_alive')
 def kepler_check_alive():
-    _rpt.check_alive()
+    # answered from the watchdog state, no serial round-trip
+    state = g.dev.watchdog.state
+    if state != 'up':
+        return Response(state.upper(), status=503, mimetype='text/html')
+    return Response("OK", mimetype='text/html')
+
+@device_bp.route('/api/health')
+def device_health():
+    return jsonify(g.dev.health())
+
+@device_bp.route('/api/trace/start', methods=['POST'])
+def trace_start():
+    """Record every RPC call of this unit to a new trace file, replacing a running recording."""
+    os.makedirs(trace_dir, exist_ok=True)
+    path = os.path.join(trace_dir, '{}-{}.ktrace'.format(g.dev.id, time.strftime('%Y%m%d-%H%M%S')))
+    g.dev.kepler.start_trace(path)
+    return jsonify({'path': path})
+
+@device_bp.route('/api/trace/stop', methods=['POST'])
+def trace_stop():
+    return jsonify({'records': g.dev.kepler.stop_trace()})
+
+app.register_blueprint(device_bp)
+app.register_blueprint(device_bp, url_prefix='/dev/<dev_id>', name='dev')
+
+@app.route('/healthz')
+def healthz():
+    return Response("OK", mimetype='text/plain')
 
-try:
-    _kepler = Kepler(port=port_kepler)
-except:
-    print("\nCheck USB Connection for Kepler Module\n")
-    exit(0)
+@app.route('/readyz')
+def readyz():
+    devices = {dev.id: dev.startup for dev in _devices}
+    ready = len(devices) > 0 and all(dev.ready.is_set() for dev in _devices)
+    resp = jsonify({'ready': ready, 'devices': devices})
+    resp.status_code = 200 if ready else 503
+    return resp
 
-_rpt = Repeater(_kepler)
+@app.route('/api/jobs')
+def job_list():
+    return jsonify([job.to_dict(tail=0) for job in _jobs.list()])
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    """State, progress and the last ?tail= log lines of a job."""
+    job = _jobs.get(job_id)
+    if job is None:
+        return Response("no such job", status=404, mimetype='text/html')
+    return jsonify(job.to_dict(tail=request.args.get('tail', 20, type=int)))
+
+@app.route('/api/fleet/status')
+def fleet_status():
+    """Status of every unit, ?refresh=1 resamples them (in parallel) instead of serving the last snapshots."""
+    refresh = request.args.get('refresh', 0, type=int) != 0
+    return Response(json.dumps(_devices.fleet_status(refresh), default=json_default), mimetype='application/json')
+
+def _per_device(fn):
+    # {(dev_id,): value} for the metrics callbacks, units still starting are skipped
+    return lambda: {(dev.id,): fn(dev) for dev in _devices if dev.kepler is not None}
+
+metrics.REGISTRY.register(metrics.Callback('kepler_serial_queue_depth', 'Requests waiting for the serial link',
+                                           _per_device(lambda dev: dev.kepler.queue_depth()), labels=['device']))
+metrics.REGISTRY.register(metrics.Callback('kepler_module_up', 'Module heartbeat state is up',
+                                           _per_device(lambda dev: int(dev.watchdog is not None and dev.watchdog.is_up())), labels=['device']))
+metrics.REGISTRY.register(metrics.Callback('kepler_cache_hits_total', 'Register cache hits',
+                                           _per_device(lambda dev: dev.kepler.cache_stats()['hits']), kind='counter', labels=['device']))
+metrics.REGISTRY.register(metrics.Callback('kepler_cache_misses_total', 'Register cache misses',
+                                           _per_device(lambda dev: dev.kepler.cache_stats()['misses']), kind='counter', labels=['device']))
+
+startup_retry_secs = 5.
+
+def load_devices():
+    """Fill the registry from devices_config, or with the single built-in unit."""
+    configs = load_device_configs(devices_config)
+    if configs is None:
+        configs = [{'id': 'kepler0', 'port': port_kepler, 'gpio_reset': gpio_kepler, 'gpio_ue': gpio_ue}]
+    for conf in configs:
+        conf = dict(conf)
+        dev_id = conf.pop('id')
+        if len(configs) > 1:
+            conf.setdefault('journal_dir', os.path.join(telemetry_journal_dir, dev_id) if telemetry_journal_dir else None)
+            conf.setdefault('savefile', '.kepler_server_config-{}.json'.format(dev_id))
+        else:
+            # a single unit, built in or from devices_config, keeps the one-module paths
+            conf.setdefault('journal_dir', telemetry_journal_dir)
+        if conf.get('gpio_reset') is not None:
+            GPIO.setup(conf['gpio_reset'], GPIO.OUT)
+        if replay:
+            make_cli = lambda port, path=replay.format(id=dev_id): ReplayKeplerRPC(path, port, timing=replay_timing)
+        elif simulate:
+            make_cli = lambda port: SimKeplerRPC(port, latency=sim_latency)
+        else:
+            make_cli = None
+        _devices.add(Device(dev_id, make_cli=make_cli, trace=trace_path.format(id=dev_id) if trace_path else None,
+                            journal_opts={'segment_records': telemetry_segment_records, 'max_segments': telemetry_max_segments},
+                            sampler_opts={'interval': status_interval, 'config_every': config_refresh_every},
+                            watchdog_opts={'interval': heartbeat_interval, 'timeout': heartbeat_timeout},
+                            fast_opts={'max_secs': fast_sample_max_secs, 'lease_secs': fast_sample_lease_secs}, **conf))
 
 app.config['PROPAGATE_EXCEPTIONS'] = True
-print("Listening on port 5000...")
-#app.run(threaded=False, processes=1, debug=True, host='0.0.0.0', port=5000)
-serve(app, listen='0.0.0.0:5000', threads=1, connection_limit=20)
 
+def _exit_on_signal(signum, frame):
+    # SIGTERM does not run atexit, exit normally so pending config saves and traces get flushed
+    logger.info("%s received, shutting down", signal.Signals(signum).name)
+    raise SystemExit(0)
+
+def main():
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    signal.signal(signal.SIGINT, _exit_on_signal)
+    load_devices()
+    _devices.start(startup_retry_secs)
+    logger.info("Listening on %s...", listen)
+    #app.run(threaded=False, processes=1, debug=True, host='0.0.0.0', port=5000)
+    serve(app, listen=listen, threads=http_threads, connection_limit=20)
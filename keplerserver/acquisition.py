@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from . import metrics
+from .configstore import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+SYNC_IDLE = 0
+SYNC_SEARCHING = 1
+SYNC_OK = 2
+
+# a search on the cached ARFCN that has not locked after this long (s) falls
+# back to the wide search, which is given up on after SEARCH_TIMEOUT
+TARGETED_TIMEOUT = 3.
+SEARCH_TIMEOUT = 120.
+POLL_INTERVAL = 0.2
+
+def _cell_key(center_freq, rfbw):
+  return '{:.3f}/{}'.format(center_freq, rfbw)
+
+class SyncCache():
+  """Last locked cell (arfcn, cellid, lindex) per center frequency and bandwidth, persisted as JSON.
+
+  Also remembers the ARFCN of a targeted search still programmed into the
+  module, so it is not mistaken for a pinned one after a server restart.
+  """
+
+  def __init__(self, path):
+    self._path = path
+    self._lock = threading.Lock()
+    self._cells = {}
+    self._speculative = None
+    if os.path.exists(path):
+      try:
+        with open(path) as f:
+          data = json.load(f)
+        self._cells = data.get('cells', {})
+        self._speculative = data.get('speculative')
+      except (OSError, ValueError) as e:
+        logger.warning('ignoring sync cache %s : %s', path, e)
+
+  def get(self, center_freq, rfbw):
+    with self._lock:
+      cell = self._cells.get(_cell_key(center_freq, rfbw))
+      return None if cell is None else dict(cell)
+
+  def put(self, center_freq, rfbw, arfcn, cellid, lindex):
+    cell = {'arfcn': int(arfcn), 'cellid': int(cellid), 'lindex': int(lindex)}
+    with self._lock:
+      key = _cell_key(center_freq, rfbw)
+      old = self._cells.get(key)
+      if old is not None and all(old.get(k) == v for k, v in cell.items()):
+        return
+      cell['t'] = time.time()
+      self._cells[key] = cell
+      self._save()
+
+  @property
+  def speculative(self):
+    return self._speculative
+
+  def set_speculative(self, arfcn):
+    with self._lock:
+      if arfcn == self._speculative:
+        return
+      self._speculative = arfcn
+      self._save()
+
+  def _save(self):
+    try:
+      write_json_atomic(self._path, {'cells': self._cells, 'speculative': self._speculative})
+    except OSError as e:
+      logger.error('saving sync cache to %s failed : %s', self._path, e)
+
+class SyncAcquisition():
+  """Starts the TDD sync search after a retune and follows it until lock.
+
+  With no pinned ARFCN the search first targets the cell last locked at this
+  center frequency and bandwidth, and only falls back to the wide search when
+  that has not locked within targeted_timeout. The search is followed on a
+  background thread which records the locked cell and the time to sync.
+  """
+
+  def __init__(self, keplerobj, cache_path, targeted_timeout=TARGETED_TIMEOUT, search_timeout=SEARCH_TIMEOUT,
+               interval=POLL_INTERVAL):
+    self._kepler = keplerobj
+    self.cache = SyncCache(cache_path)
+    self._targeted_timeout = targeted_timeout
+    self._search_timeout = search_timeout
+    self._interval = interval
+    self._lock = threading.Lock()
+    self._gen = 0
+    self.last = None
+
+  @property
+  def speculative_arfcn(self):
+    """ARFCN of the targeted search this manager programmed, not a user pinned one."""
+    return self.cache.speculative
+
+  def cancel(self):
+    """Stop following the current search, called before the sync is stopped."""
+    with self._lock:
+      self._gen += 1
+
+  def start(self, config):
+    """Start the search for config (center_freq in MHz, rfbw, arfcn), returns how the cell is searched."""
+    with self._lock:
+      self._gen += 1
+      gen = self._gen
+      t0 = time.monotonic()
+      cached = self.cache.get(config['center_freq'], config['rfbw']) if config['arfcn'] == 0 else None
+      try:
+        if config['arfcn'] != 0:
+          method = 'pinned'
+          self.cache.set_speculative(None)
+          self._kepler.call('tdd_sync_start_search_arfcn', 6, 1, config['arfcn'])
+        elif cached is not None:
+          method = 'targeted'
+          self.cache.set_speculative(cached['arfcn'])
+          self._kepler.call('tdd_sync_start_search_arfcn', 6, 1, cached['arfcn'])
+        else:
+          method = 'wide'
+          self._wide_search(config)
+      except Exception as e:
+        logger.warning('starting the TDD sync search failed : %s', e)
+        return None
+    logger.info('TDD sync search started (%s%s)', method, '' if cached is None else ' arfcn {}'.format(cached['arfcn']))
+    threading.Thread(target=self._follow, args=(gen, dict(config), method, t0), name='tdd-acquire',
+                     daemon=True).start()
+    return method
+
+  def _wide_search(self, config):
+    self.cache.set_speculative(None)
+    if config['rfbw'] == 999:
+      self._kepler.call('tdd_sync_start_search', 6, 1)
+    else:
+      self._kepler.call('tdd_sync_start_search', 6, 1, config['center_freq']*1e6 - config['rfbw']*1e6/2,
+                        config['center_freq']*1e6 + config['rfbw']*1e6/2)
+
+  def _follow(self, gen, config, method, t0):
+    while True:
+      time.sleep(self._interval)
+      if gen != self._gen:
+        return
+      try:
+        stat = self._kepler.call('tdd_sync_status')
+      except Exception as e:
+        # the watchdog deals with a module that stopped answering
+        logger.debug('tdd_sync_status failed : %s', e)
+        stat = None
+      elapsed = time.monotonic() - t0
+      with self._lock:
+        if gen != self._gen:
+          return
+        if stat is not None and stat[0] == SYNC_OK:
+          self.cache.put(config['center_freq'], config['rfbw'], stat[1], stat[2], stat[3])
+          self.last = {'method': method, 'secs': elapsed, 'arfcn': int(stat[1]), 'cellid': int(stat[2])}
+          metrics.tdd_time_to_sync.observe(elapsed, method)
+          logger.info('TDD sync locked on arfcn %d cell %d after %.1f s (%s)', stat[1], stat[2], elapsed, method)
+          return
+        # a module that gave up on the cached cell goes back to idle before the timeout
+        if method == 'targeted' and (elapsed >= self._targeted_timeout or (stat is not None and stat[0] == SYNC_IDLE)):
+          logger.info('no lock on the cached cell after %.1f s, falling back to the wide search', elapsed)
+          metrics.tdd_sync_timeouts.inc(method)
+          method = 'fallback'
+          try:
+            # the targeted search may still be running, stop it before restarting wide
+            self._kepler.call('tdd_sync_stop')
+            self._wide_search(config)
+          except Exception as e:
+            logger.warning('starting the wide TDD sync search failed : %s', e)
+            return
+        elif elapsed >= self._search_timeout:
+          logger.warning('TDD sync search (%s) did not lock within %.0f s', method, self._search_timeout)
+          metrics.tdd_sync_timeouts.inc(method)
+          self.last = {'method': method, 'secs': None, 'arfcn': None, 'cellid': None}
+          return
@@ -0,0 +1,124 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# magnitude of a full-scale complex sample of an int16 I/Q capture, 0 dBFS
+CAPTURE_FULL_SCALE = 32768.
+
+# signal path -> (boxcal conversion, sign) turning a dBFS reading into dBm
+PATH_CONVERSIONS = {
+  'dl_rx': ('donorrx_dbm2dbfs', -1.),
+  'ul_rx': ('serverrx_dbm2dbfs', -1.),
+  'dl_tx': ('servertx_dbfs2dbm', 1.),
+  'ul_tx': ('donortx_dbfs2dbm', 1.),
+}
+
+def _db(power):
+  with np.errstate(divide='ignore'):
+    return 10 * np.log10(power)
+
+def boxcal_conversions(boxcal_data, dl_atten, ul_atten):
+  """dBm <-> dBFS conversions of the two chains of each path, from the boxcal data and the RX attenuators."""
+  boxcal_data = np.asarray(boxcal_data, dtype='float64')
+  return {
+    'donorrx_dbm2dbfs': (boxcal_data[8] - np.asarray(dl_atten[2:4]) / 4) + boxcal_data[0:2],
+    'donortx_dbfs2dbm': boxcal_data[2:4],
+    'serverrx_dbm2dbfs': (boxcal_data[9] - np.asarray(ul_atten[2:4]) / 4) + boxcal_data[4:6],
+    'servertx_dbfs2dbm': boxcal_data[6:8],
+  }
+
+def path_offsets(paths, conversions):
+  """dB offsets turning dBFS into dBm for paths like 'dl_rx_1', 'ul_tx_2'."""
+  offsets = []
+  for path in paths:
+    name, _, chain = path.rpartition('_')
+    if name not in PATH_CONVERSIONS or chain not in ['1', '2']:
+      raise ValueError('unknown signal path {}'.format(path))
+    conv, sign = PATH_CONVERSIONS[name]
+    offsets.append(sign * conversions[conv][int(chain) - 1])
+  return np.asarray(offsets)
+
+def deinterleave(x, channels=1):
+  """(channels, n) view of a capture holding channels interleaved sample by sample."""
+  if channels < 1:
+    raise ValueError('channels must be at least 1, got {}'.format(channels))
+  n = len(x) // channels
+  if n == 0:
+    raise ValueError('capture shorter than {} channels'.format(channels))
+  return x[:n * channels].reshape(n, channels).T
+
+def welch_psd(x, nfft=1024, overlap=0.5, averages=None, fs=None):
+  """Welch power spectrum of each row of x, in dBFS per bin, DC centered.
+
+  x is (channels, n) complex. Segments of nfft samples with the given
+  overlap fraction are Hann windowed and their power spectra averaged; at
+  most averages segments are used. A full-scale tone reads 0 dBFS.
+  Returns (freqs, psd, segments); freqs are in Hz when fs is given,
+  otherwise in cycles per sample.
+  """
+  x = np.atleast_2d(x)
+  if nfft < 8 or nfft > x.shape[-1]:
+    raise ValueError('nfft must be between 8 and the capture length ({})'.format(x.shape[-1]))
+  if not 0 <= overlap < 1:
+    raise ValueError('overlap must be in [0, 1)')
+  step = max(1, int(nfft * (1 - overlap)))
+  segs = sliding_window_view(x, nfft, axis=-1)[:, ::step]
+  if averages is not None:
+    segs = segs[:, :max(1, averages)]
+  window = np.hanning(nfft).astype('float32')
+  spec = np.fft.fft(segs * window, axis=-1)
+  power = np.mean(spec.real ** 2 + spec.imag ** 2, axis=1)
+  psd = _db(power / (CAPTURE_FULL_SCALE * window.sum()) ** 2)
+  freqs = np.fft.fftshift(np.fft.fftfreq(nfft, d=1. if fs is None else 1. / fs))
+  return freqs, np.fft.fftshift(psd, axes=-1), segs.shape[1]
+
+def power_stats(x):
+  """RMS and peak power in dBFS of each row of x."""
+  mag2 = x.real ** 2 + x.imag ** 2
+  fs2 = CAPTURE_FULL_SCALE ** 2
+  return _db(mag2.mean(axis=-1) / fs2), _db(mag2.max(axis=-1) / fs2)
+
+def iq_imbalance(x):
+  """Blind DC offset and IQ gain/phase imbalance estimate of each row of x.
+
+  Returns (dc_dbfs, gain_db, phase_deg, irr_db): DC level, I/Q amplitude
+  ratio, quadrature error and the resulting image rejection ratio.
+  """
+  dc = x.mean(axis=-1, keepdims=True)
+  y = x - dc
+  pi = np.mean(y.real ** 2, axis=-1)
+  pq = np.mean(y.imag ** 2, axis=-1)
+  piq = np.mean(y.real * y.imag, axis=-1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    g = np.sqrt(pi / pq)
+    phi = np.arcsin(np.clip(piq / np.sqrt(pi * pq), -1., 1.))
+    irr = _db((1 + 2 * g * np.cos(phi) + g ** 2) / (1 - 2 * g * np.cos(phi) + g ** 2))
+  return _db(np.abs(dc[..., 0]) ** 2 / CAPTURE_FULL_SCALE ** 2), 20 * np.log10(g), np.degrees(phi), irr
+
+def analyze_capture(x, channels=1, nfft=1024, overlap=0.5, averages=None, fs=None, offsets=None):
+  """Spectrum and power summary of a complex capture, compact float32 arrays keyed by name.
+
+  offsets (dB per channel, see path_offsets) adds the dBm power figures.
+  """
+  x = deinterleave(np.asarray(x), channels)
+  freqs, psd, segments = welch_psd(x, nfft, overlap, averages, fs)
+  rms, peak = power_stats(x)
+  dc, gain, phase, irr = iq_imbalance(x)
+  result = {
+    'samples': x.shape[-1],
+    'segments': segments,
+    'freqs': freqs.astype('float32'),
+    'psd_dbfs': psd.astype('float32'),
+    'rms_dbfs': rms.astype('float32'),
+    'peak_dbfs': peak.astype('float32'),
+    'dc_dbfs': dc.astype('float32'),
+    'iq_gain_db': gain.astype('float32'),
+    'iq_phase_deg': phase.astype('float32'),
+    'irr_db': irr.astype('float32'),
+  }
+  if offsets is not None:
+    offsets = np.asarray(offsets, dtype='float64')
+    if offsets.shape != (x.shape[0],):
+      raise ValueError('need one path per channel')
+    result['rms_dbm'] = (rms + offsets).astype('float32')
+    result['peak_dbm'] = (peak + offsets).astype('float32')
+  return result
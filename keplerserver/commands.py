@@ -0,0 +1,51 @@
+import functools
+import re
+
+# argument types of the RPC methods used through /api/kepler, anything not
+# listed here (or extra arguments) falls back to guessing from the token
+COMMAND_SIGNATURES = {
+  'vendor': (int,),
+  'center_freq': (float,),
+  'gain': (float,),
+  'mode': (int, int),
+  'pa_enable': (int, int),
+  'dl_atten': (int, int, int, int),
+  'ul_atten': (int, int, int, int),
+  'tdd_mode': (int, int),
+  'tuner_lowgain_mode': (int,),
+  'bypass_chan_fir': (int,),
+  'chan_fir_bank_sel': (int,),
+  'pilot_enable': (int,),
+  'tdd_frame_schedule': (int, int, int, int, int, int, int, str),
+  'tdd_sync_start_search': (int, int, float, float),
+  'tdd_sync_start_search_arfcn': (int, int, int),
+}
+
+# a token is a double-quoted string or a run of anything but separators
+_TOKEN_RE = re.compile(r'"([^"]*)"|([^,\s"]+)')
+
+def _guess(token):
+  return float(token) if '.' in token or 'e' in token else int(token)
+
+def convert_args(method, args):
+  """Coerce a list of argument values to the types in COMMAND_SIGNATURES."""
+  sig = COMMAND_SIGNATURES.get(method, ())
+  return tuple(sig[i](a) if i < len(sig) and a is not None else a for i, a in enumerate(args))
+
+@functools.lru_cache(maxsize=1024)
+def parse_command(command):
+  """Parse 'method,arg1,arg2,...' into (method, args), results are memoized."""
+  tokens = _TOKEN_RE.findall(command)
+  if not tokens:
+    raise ValueError('empty command')
+  method = tokens[0][1] or tokens[0][0]
+  sig = COMMAND_SIGNATURES.get(method, ())
+  args = []
+  for i, (quoted, bare) in enumerate(tokens[1:]):
+    if not bare:
+      args.append(quoted)
+    elif i < len(sig):
+      args.append(sig[i](bare))
+    else:
+      args.append(_guess(bare))
+  return method, tuple(args)
@@ -0,0 +1,144 @@
+import atexit
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FORMAT_VERSION = 1
+
+def _json_default(obj):
+  if isinstance(obj, np.generic):
+    return obj.item()
+  raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+def write_json_atomic(path, data):
+  """Write data as JSON to a temp file, fsync it and rename it over path."""
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(data, f, indent=1, sort_keys=True, default=_json_default)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp, path)
+  # make the rename itself durable, this syncs the directory only
+  dirfd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+  try:
+    os.fsync(dirfd)
+  finally:
+    os.close(dirfd)
+
+def config_diff(old, new):
+  """key -> [old, new] for every key whose value differs."""
+  return {k: [old.get(k), new.get(k)] for k in sorted(set(old) | set(new)) if old.get(k) != new.get(k)}
+
+class ConfigStore():
+  """Write-behind store of the repeater config.
+
+  save() only records the config; bursts of saves within delay seconds are
+  coalesced into one write. A write goes to a temp file, is fsync'd and
+  atomically renamed over the store, so the file is always either the old
+  or the new version. The file is versioned JSON and keeps a journal of the
+  last journal_len changes for rollback.
+  """
+
+  def __init__(self, path, delay=1.0, journal_len=50, legacy_path=None):
+    self._path = path
+    self._delay = delay
+    self._journal_len = journal_len
+    self._legacy_path = legacy_path
+    self._lock = threading.Lock()
+    self._write_lock = threading.Lock()
+    self._timer = None
+    self._config = None
+    self._journal = []
+    self._dirty = False
+    self.writes = 0
+    atexit.register(self.flush)
+
+  def load(self, default=None):
+    """Return the stored config (None if there is none) and make it the base of the journal.
+
+    With nothing stored, default (the running config) becomes the base, so
+    the first save is journaled and can be rolled back too.
+    """
+    with self._lock:
+      if os.path.exists(self._path):
+        with open(self._path) as f:
+          data = json.load(f)
+        if data.get('version') != CONFIG_FORMAT_VERSION:
+          raise ValueError('{}: unsupported config version {}'.format(self._path, data.get('version')))
+        self._config = data['config']
+        self._journal = data.get('journal', [])
+      elif self._legacy_path is not None and os.path.exists(self._legacy_path):
+        # pickle written by earlier versions, rewritten in the new format on the next save
+        with open(self._legacy_path, 'rb') as f:
+          self._config = pickle.load(f)
+        logger.info('migrating config from %s to %s', self._legacy_path, self._path)
+      else:
+        self._config = None if default is None else dict(default)
+        return None
+      return None if self._config is None else dict(self._config)
+
+  def save(self, config):
+    """Record config, the file is written at most delay seconds later."""
+    config = dict(config)
+    with self._lock:
+      if self._config is not None:
+        changes = config_diff(self._config, config)
+        if not changes:
+          return
+        self._journal.append({'t': time.time(), 'changes': changes})
+        del self._journal[:-self._journal_len]
+      self._config = config
+      self._dirty = True
+      if self._timer is None:
+        self._timer = threading.Timer(self._delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+  def flush(self):
+    """Write pending changes now."""
+    # one writer at a time, so an older snapshot never lands after a newer one
+    with self._write_lock:
+      with self._lock:
+        if self._timer is not None:
+          self._timer.cancel()
+          self._timer = None
+        if not self._dirty:
+          return
+        data = {'version': CONFIG_FORMAT_VERSION, 'saved': time.time(), 'config': self._config,
+                'journal': list(self._journal)}
+        self._dirty = False
+      # saves keep being recorded while the card is busy
+      try:
+        self._write(data)
+      except OSError as e:
+        logger.error('saving config to %s failed : %s', self._path, e)
+        with self._lock:
+          self._dirty = True
+
+  def _write(self, data):
+    write_json_atomic(self._path, data)
+    self.writes += 1
+
+  def journal(self):
+    with self._lock:
+      return [dict(entry) for entry in self._journal]
+
+  def rollback_target(self, steps=1):
+    """The config as it was steps changes ago."""
+    with self._lock:
+      if steps < 1 or steps > len(self._journal):
+        raise ValueError('can roll back 1 to {} changes'.format(len(self._journal)))
+      config = dict(self._config)
+      for entry in reversed(self._journal[-steps:]):
+        for k, (old, new) in entry['changes'].items():
+          if old is None:
+            config.pop(k, None)
+          else:
+            config[k] = old
+      return config
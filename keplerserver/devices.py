@@ -0,0 +1,164 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+
+from .kepler import Kepler
+from .repeater import Repeater
+from .sampler import StatusSampler
+from .journal import TelemetryJournal
+from .watchdog import Watchdog
+from .fastsample import FastSampler
+
+logger = logging.getLogger(__name__)
+
+# keys of one entry of the devices config file
+DEVICE_KEYS = ['id', 'port', 'gpio_reset', 'gpio_ue', 'journal_dir', 'savefile']
+
+class Device():
+  """One Kepler unit: its serial link, Repeater, status sampler and GPIO lines.
+
+  Everything device-backed is None until start() reaches the 'ready' stage.
+  """
+
+  def __init__(self, dev_id, port, gpio_reset=None, gpio_ue=None, journal_dir=None,
+               savefile='.kepler_server_config.json', make_cli=None, journal_opts=None, sampler_opts=None,
+               watchdog_opts=None, fast_opts=None, trace=None):
+    self.id = dev_id
+    self.port = port
+    self.gpio_reset = gpio_reset
+    self.gpio_ue = gpio_ue
+    self.journal_dir = journal_dir
+    self.savefile = savefile
+    # RPC trace file recorded from the first call on (see trace.TraceWriter)
+    self.trace = trace
+    self._make_cli = make_cli
+    self._journal_opts = dict(journal_opts or {})
+    self._sampler_opts = dict(sampler_opts or {})
+    self._watchdog_opts = dict(watchdog_opts or {})
+    self._fast_opts = dict(fast_opts or {})
+    self.kepler = None
+    self.journal = None
+    self.rpt = None
+    self.sampler = None
+    self.watchdog = None
+    self.fast = None
+    self.ready = threading.Event()
+    self.startup = {'stage': 'starting', 'error': None, 'started': time.time(), 'ready_secs': None}
+
+  def _set_stage(self, stage, error=None):
+    self.startup['stage'] = stage
+    self.startup['error'] = error
+    logger.info("%s startup: %s", self.id, stage)
+
+  def start(self, retry_secs=5.):
+    """Open the module, bring the Repeater up and start the sampler, then flag ready."""
+    self._set_stage('opening')
+    while self.kepler is None:
+      try:
+        self.kepler = Kepler(port=self.port, cli=self._make_cli(self.port) if self._make_cli else None,
+                             trace=self.trace)
+      except Exception as e:
+        logger.error("%s: check USB connection for Kepler module : %s", self.id, e)
+        self._set_stage('opening', str(e))
+        time.sleep(retry_secs)
+
+    self._set_stage('initializing')
+    if self.journal_dir:
+      self.journal = TelemetryJournal(self.journal_dir, **self._journal_opts)
+    while self.rpt is None:
+      try:
+        self.rpt = Repeater(self.kepler, journal=self.journal, savefile=self.savefile)
+      except Exception as e:
+        logger.exception("%s: Repeater init failed", self.id)
+        self._set_stage('initializing', str(e))
+        time.sleep(retry_secs)
+    self.watchdog = Watchdog(self.rpt, **self._watchdog_opts)
+    self.watchdog.start()
+    self.sampler = StatusSampler(self.rpt, gate=self.watchdog.is_up, **self._sampler_opts)
+    self.sampler.start()
+    self.fast = FastSampler(self.kepler, gate=self.watchdog.is_up, **self._fast_opts)
+
+    self.startup['ready_secs'] = time.time() - self.startup['started']
+    self._set_stage('ready')
+    self.ready.set()
+
+  def health(self):
+    """Module health from the watchdog, no serial I/O."""
+    if self.watchdog is None:
+      return {'state': self.startup['stage']}
+    return self.watchdog.health()
+
+  def status(self, refresh=False):
+    """Latest status snapshot as a plain dict, resampled first if refresh (only while the module is up)."""
+    if not self.ready.is_set():
+      return {'ready': False, 'stage': self.startup['stage'], 'error': self.startup['error']}
+    refresh = refresh and self.watchdog.is_up()
+    snap = self.sampler.refresh() if refresh else self.sampler.snapshot()
+    return {'ready': True, 'health': self.health(), 'timestamp': snap.timestamp,
+            'kstat': dict(snap.kstat), 'tstat': dict(snap.tstat)}
+
+class DeviceRegistry():
+  """The Kepler units served by this process, the first one added is the default."""
+
+  def __init__(self):
+    self._devices = collections.OrderedDict()
+
+  def add(self, device):
+    if device.id in self._devices:
+      raise ValueError('duplicate device id {}'.format(device.id))
+    self._devices[device.id] = device
+    return device
+
+  def get(self, dev_id):
+    return self._devices.get(dev_id)
+
+  @property
+  def default(self):
+    return next(iter(self._devices.values()), None)
+
+  def __iter__(self):
+    return iter(list(self._devices.values()))
+
+  def __len__(self):
+    return len(self._devices)
+
+  def start(self, retry_secs=5.):
+    """Start every device on its own thread, units come up independently."""
+    for dev in self:
+      threading.Thread(target=dev.start, args=(retry_secs,), name='startup-{}'.format(dev.id), daemon=True).start()
+
+  def fleet_status(self, refresh=False):
+    """dev_id -> Device.status(), units are sampled in parallel when refreshing."""
+    devices = list(self)
+    if not refresh or len(devices) < 2:
+      return collections.OrderedDict((dev.id, dev.status(refresh)) for dev in devices)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(devices)) as pool:
+      futures = [(dev.id, pool.submit(dev.status, True)) for dev in devices]
+    result = collections.OrderedDict()
+    for dev_id, fut in futures:
+      try:
+        result[dev_id] = fut.result()
+      except Exception as e:
+        result[dev_id] = {'ready': True, 'error': str(e)}
+    return result
+
+def load_device_configs(path):
+  """Device entries from a JSON file {"devices": [{"id": ..., "port": ..., "gpio_reset": ...}, ...]}.
+
+  Returns None when the file does not exist.
+  """
+  if not path or not os.path.exists(path):
+    return None
+  with open(path) as f:
+    entries = json.load(f)['devices']
+  configs = []
+  for entry in entries:
+    unknown = set(entry) - set(DEVICE_KEYS)
+    if unknown or 'id' not in entry or 'port' not in entry:
+      raise ValueError('{}: bad device entry {}'.format(path, entry))
+    configs.append(dict(entry))
+  return configs
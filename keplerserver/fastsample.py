@@ -0,0 +1,177 @@
+import logging
+import math
+import threading
+import time
+import uuid
+import numpy as np
+
+from .history import decimate, layout_fields
+
+logger = logging.getLogger(__name__)
+
+# column layout of one fast sample, (field, width); levels in dBFS straight
+# from read_powers, accum is the raw accum_status (accum_status[1] != 0 is OSC)
+FAST_LAYOUT = [
+  ('dac_pwr', 4),
+  ('adc_pwr', 4),
+  ('dac_pwr_max', 4),
+  ('adc_pwr_max', 4),
+  ('accum', 2),
+]
+
+FAST_FIELDS, FAST_WIDTH = layout_fields(FAST_LAYOUT)
+
+# read_powers entries of the level columns
+_READ_POWERS_INDEX = np.r_[0:8, 12:20]
+
+MIN_RATE = 1.
+MAX_RATE = 50.
+
+class FastSampler():
+  """On-demand high-rate sampling of read_powers and accum_status.
+
+  A session reads only those two registers at rate Hz for at most duration
+  seconds into a buffer preallocated for the whole session, the status
+  sampler keeps its own pace. Clients hold leases which they renew by reading
+  envelopes; the session stops on its own once the last lease expires.
+  """
+
+  def __init__(self, keplerobj, max_secs=120., lease_secs=10., gate=None):
+    self._kepler = keplerobj
+    self._max_secs = max_secs
+    self._lease_secs = lease_secs
+    # samples are skipped while gate() is false (e.g. module not up)
+    self._gate = gate
+    self._lock = threading.Lock()
+    self._leases = {}
+    self._thread = None
+    self._stop = threading.Event()
+    self._rate = None
+    self._t = np.zeros(0, dtype='float64')
+    self._data = np.zeros((0, FAST_WIDTH), dtype='float32')
+    self._count = 0
+    self.started = None
+    self._until = None
+
+  @property
+  def running(self):
+    return self._thread is not None
+
+  def subscribe(self, rate=20., duration=30.):
+    """Take a lease, starting a session at rate Hz for duration s unless one is running.
+
+    Returns the lease id and the session parameters (a running session keeps its rate).
+    """
+    if not MIN_RATE <= rate <= MAX_RATE:
+      raise ValueError('rate must be {:g} to {:g} Hz'.format(MIN_RATE, MAX_RATE))
+    if not 0 < duration <= self._max_secs:
+      raise ValueError('duration must be at most {:g} s'.format(self._max_secs))
+    lease = uuid.uuid4().hex[:16]
+    with self._lock:
+      self._leases[lease] = time.monotonic() + self._lease_secs
+      if self._thread is None:
+        self._start(rate, duration)
+      return {'lease': lease, 'rate': self._rate, 'started': self.started, 'until': self._until,
+              'lease_secs': self._lease_secs}
+
+  def unsubscribe(self, lease):
+    with self._lock:
+      self._leases.pop(lease, None)
+
+  def renew(self, lease):
+    """Extend lease, False if it expired or is unknown."""
+    with self._lock:
+      if lease not in self._leases:
+        return False
+      self._leases[lease] = time.monotonic() + self._lease_secs
+      return True
+
+  def _start(self, rate, duration):
+    # must hold self._lock
+    capacity = int(math.ceil(rate * duration))
+    self._t = np.zeros(capacity, dtype='float64')
+    self._data = np.full((capacity, FAST_WIDTH), np.nan, dtype='float32')
+    self._count = 0
+    self._rate = rate
+    self.started = time.time()
+    self._until = self.started + duration
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, args=(capacity,), name='fast-sampler', daemon=True)
+    self._thread.start()
+    logger.info('fast sampling at %g Hz for %g s', rate, duration)
+
+  def stop(self):
+    self._stop.set()
+    thread = self._thread
+    if thread is not None and thread is not threading.current_thread():
+      thread.join()
+
+  def _leased(self):
+    # drop expired leases, True while any is left; must hold self._lock
+    now = time.monotonic()
+    for lease in [l for l, expiry in self._leases.items() if expiry < now]:
+      del self._leases[lease]
+    return bool(self._leases)
+
+  def _run(self, capacity):
+    period = 1. / self._rate
+    deadline = time.monotonic()
+    # skipped samples do not extend the session
+    end = deadline + capacity * period
+    try:
+      while self._count < capacity and time.monotonic() < end and not self._stop.is_set():
+        with self._lock:
+          if not self._leased():
+            logger.info('fast sampling stopped, no clients left')
+            break
+        if self._gate is None or self._gate():
+          try:
+            self._sample()
+          except Exception as e:
+            logger.warning('fast sample failed : %s', e)
+        # fixed schedule, a slow read does not shift the following samples
+        deadline += period
+        delay = deadline - time.monotonic()
+        if delay < 0:
+          deadline -= delay
+        elif self._stop.wait(delay):
+          break
+    finally:
+      # leases outlive the session, a client sees running False and subscribes again
+      with self._lock:
+        self._thread = None
+
+  def _sample(self):
+    read_powers, accum_status = self._kepler.call_many([('read_powers',), ('accum_status',)])
+    now = time.time()
+    with self._lock:
+      i = self._count
+      row = self._data[i]
+      row[:len(_READ_POWERS_INDEX)] = np.asarray(read_powers, dtype='float32')[_READ_POWERS_INDEX]
+      row[FAST_FIELDS['accum']] = accum_status[:2]
+      self._t[i] = now
+      self._count = i + 1
+
+  def envelope(self, width=None, fields=None, start=None):
+    """Samples of the current (or last) session after start, decimated to at most width buckets.
+
+    Returns a dict with the bucket end times 't', the samples per bucket
+    'count' and, per requested field, 'min'/'max'/'last' arrays of shape
+    (buckets, field width).
+    """
+    fields = list(FAST_FIELDS) if fields is None else fields
+    for name in fields:
+      if name not in FAST_FIELDS:
+        raise ValueError('unknown fast sample field {}'.format(name))
+    with self._lock:
+      n = self._count
+      lo = 0 if start is None else int(np.searchsorted(self._t[:n], start, side='right'))
+      t = self._t[lo:n].copy()
+      data = self._data[lo:n].copy()
+      ret = {'rate': self._rate, 'started': self.started, 'running': self._thread is not None}
+    dec = decimate(t, data, width, ('min', 'max', 'last'))
+    ret['t'] = dec['t_last']
+    ret['count'] = dec['count']
+    ret['fields'] = {name: {stat: dec[stat][:, FAST_FIELDS[name]] for stat in ('min', 'max', 'last')}
+                     for name in fields}
+    return ret
@@ -0,0 +1,115 @@
+import threading
+import numpy as np
+
+# column layout of one telemetry sample, (field, width)
+TELEMETRY_LAYOUT = [
+  ('read_powers', 24),
+  ('fullchan_pwrs', 8),
+  ('delchan_pwrs', 8),
+  ('gain', 1),
+]
+
+def layout_fields(layout):
+  """Return (name -> column slice, total width) for a [(field, width)] layout."""
+  fields = {}
+  width = 0
+  for name, n in layout:
+    fields[name] = slice(width, width + n)
+    width += n
+  return fields, width
+
+TELEMETRY_FIELDS, TELEMETRY_WIDTH = layout_fields(TELEMETRY_LAYOUT)
+
+def decimate(t, data, width, stats=('min', 'max', 'mean')):
+  """Reduce time-ordered rows to at most width buckets of consecutive samples.
+
+  Returns a dict with the mean 't' and last 't_last' sample time of each
+  bucket, the samples per bucket 'count' and, for each of stats ('min',
+  'max', 'mean', 'last'), an array of shape (buckets, data columns). Rows
+  pass through unchanged when there are no more than width of them.
+  """
+  n = len(t)
+  if width is None or not 0 < width < n:
+    ret = {'t': t, 't_last': t, 'count': np.ones(n, dtype='int64')}
+    ret.update((stat, data) for stat in stats)
+    return ret
+  edges = (np.arange(width) * n) // width
+  counts = np.diff(np.append(edges, n))
+  last = edges + counts - 1
+  ret = {'t': np.add.reduceat(t, edges) / counts, 't_last': t[last], 'count': counts}
+  for stat in stats:
+    if stat == 'min':
+      ret[stat] = np.minimum.reduceat(data, edges, axis=0)
+    elif stat == 'max':
+      ret[stat] = np.maximum.reduceat(data, edges, axis=0)
+    elif stat == 'mean':
+      ret[stat] = np.add.reduceat(data, edges, axis=0) / counts[:, None]
+    elif stat == 'last':
+      ret[stat] = data[last]
+    else:
+      raise ValueError('unknown decimation statistic {}'.format(stat))
+  return ret
+
+def fill_sample(row, **fields):
+  """Write TELEMETRY_LAYOUT fields into a preallocated row, missing or short ones are NaN-filled."""
+  row.fill(np.nan)
+  for name, values in fields.items():
+    sl = TELEMETRY_FIELDS[name]
+    values = np.ravel(values)
+    n = min(len(values), sl.stop - sl.start)
+    row[sl.start:sl.start + n] = values[:n]
+
+class TelemetryHistory():
+  """Fixed-size ring buffer of timestamped telemetry samples.
+
+  Storage is preallocated once (float64 timestamps, float32 samples with the
+  TELEMETRY_LAYOUT columns); appends write a row in place.
+  """
+
+  def __init__(self, capacity=3600):
+    self._capacity = capacity
+    self._t = np.zeros(capacity, dtype='float64')
+    self._data = np.full((capacity, TELEMETRY_WIDTH), np.nan, dtype='float32')
+    self._head = 0
+    self._count = 0
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return self._count
+
+  def append(self, t, **fields):
+    """Store one sample, fields are TELEMETRY_LAYOUT names, missing or short ones are NaN-filled."""
+    with self._lock:
+      fill_sample(self._data[self._head], **fields)
+      self._t[self._head] = t
+      self._head = (self._head + 1) % self._capacity
+      self._count = min(self._count + 1, self._capacity)
+
+  def _ordered(self):
+    # oldest first, must hold self._lock
+    start = (self._head - self._count) % self._capacity
+    idx = (start + np.arange(self._count)) % self._capacity
+    return self._t[idx], self._data[idx]
+
+  def query(self, start=None, end=None, points=None, fields=None):
+    """Return samples in [start, end], decimated to at most points buckets.
+
+    Returns a dict with the bucket times 't' and, per requested field,
+    'min'/'max'/'mean' arrays of shape (buckets, width).
+    """
+    fields = list(TELEMETRY_FIELDS) if fields is None else fields
+    for name in fields:
+      if name not in TELEMETRY_FIELDS:
+        raise ValueError('unknown telemetry field {}'.format(name))
+    with self._lock:
+      t, data = self._ordered()
+    lo = 0 if start is None else np.searchsorted(t, start, side='left')
+    hi = len(t) if end is None else np.searchsorted(t, end, side='right')
+    t = t[lo:hi]
+    data = data[lo:hi]
+    dec = decimate(t, data, points, ('min', 'max', 'mean'))
+    ret = {'t': dec['t'], 'count': dec['count'], 'fields': {}}
+    for name in fields:
+      sl = TELEMETRY_FIELDS[name]
+      ret['fields'][name] = {'min': dec['min'][:, sl], 'max': dec['max'][:, sl], 'mean': dec['mean'][:, sl]}
+    return ret
@@ -0,0 +1,140 @@
+import collections
+import logging
+import subprocess
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+class JobConflict(RuntimeError):
+  pass
+
+class Job():
+  """A long operation running on its own thread, with progress and a bounded log."""
+
+  def __init__(self, kind, key=None, device=None, log_lines=200):
+    self.id = uuid.uuid4().hex[:16]
+    self.kind = kind
+    self.key = key
+    self.device = device
+    self.state = JOB_QUEUED
+    self.stage = None
+    self.progress = 0.
+    self.result = None
+    self.error = None
+    self.created = time.time()
+    self.started = None
+    self.finished = None
+    self._log = collections.deque(maxlen=log_lines)
+    self._lock = threading.Lock()
+
+  def log(self, line):
+    line = line.rstrip()
+    logger.debug('job %s: %s', self.id, line)
+    with self._lock:
+      self._log.append((time.time(), line))
+
+  def set_progress(self, progress, stage=None):
+    with self._lock:
+      self.progress = progress
+      if stage is not None:
+        self.stage = stage
+    if stage is not None:
+      self.log('[{}]'.format(stage))
+
+  def done(self):
+    return self.state in [JOB_SUCCEEDED, JOB_FAILED]
+
+  def to_dict(self, tail=20):
+    with self._lock:
+      lines = list(self._log)[-tail:] if tail > 0 else []
+      return {'id': self.id, 'kind': self.kind, 'device': self.device, 'state': self.state,
+              'stage': self.stage, 'progress': self.progress, 'result': self.result, 'error': self.error,
+              'created': self.created, 'started': self.started, 'finished': self.finished,
+              'log': [line for _, line in lines]}
+
+  def _run(self, fn):
+    self.state = JOB_RUNNING
+    self.started = time.time()
+    try:
+      self.result = fn(self)
+      self.progress = 1.
+      self.state = JOB_SUCCEEDED
+    except Exception as e:
+      logger.warning('job %s (%s) failed : %s', self.id, self.kind, e)
+      self.error = str(e)
+      self.state = JOB_FAILED
+    finally:
+      self.finished = time.time()
+
+class JobManager():
+  """Runs jobs on background threads and keeps the most recent ones for polling.
+
+  Jobs sharing a key (e.g. the serial port they flash) never run concurrently,
+  submitting one while another is active raises JobConflict.
+  """
+
+  def __init__(self, keep=100):
+    self._keep = keep
+    self._jobs = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def submit(self, kind, fn, key=None, device=None):
+    """Start fn(job) on a new thread and return the Job."""
+    job = Job(kind, key=key, device=device)
+    with self._lock:
+      if key is not None:
+        for other in self._jobs.values():
+          if other.key == key and not other.done():
+            raise JobConflict('{} job {} is still running'.format(other.kind, other.id))
+      self._jobs[job.id] = job
+      # forget the oldest finished jobs
+      for old in [j for j in self._jobs.values() if j.done()][:max(0, len(self._jobs) - self._keep)]:
+        del self._jobs[old.id]
+    threading.Thread(target=job._run, args=(fn,), name='job-{}'.format(job.id), daemon=True).start()
+    return job
+
+  def get(self, job_id):
+    with self._lock:
+      return self._jobs.get(job_id)
+
+  def list(self):
+    with self._lock:
+      return list(self._jobs.values())
+
+def run_tool(args, log, timeout=None):
+  """Run an external tool, streaming its merged output to log line by line.
+
+  Raises RuntimeError on a non-zero exit status.
+  """
+  log('$ ' + ' '.join(args))
+  proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+  timer = threading.Timer(timeout, proc.kill) if timeout else None
+  if timer is not None:
+    timer.start()
+  try:
+    for line in proc.stdout:
+      log(line)
+    ret = proc.wait()
+  finally:
+    if timer is not None:
+      timer.cancel()
+  if ret != 0:
+    raise RuntimeError('{} exited with status {}'.format(args[0], ret))
+  return ret
+
+def gpio_pulse(gpio, pin, log, low_secs=1., settle_secs=1.):
+  """Drive pin low for low_secs, then high and wait settle_secs."""
+  gpio.setup(pin, gpio.OUT)
+  log('gpio {} low'.format(pin))
+  gpio.output(pin, False)
+  time.sleep(low_secs)
+  gpio.output(pin, True)
+  log('gpio {} high'.format(pin))
+  time.sleep(settle_secs)
@@ -0,0 +1,226 @@
+import glob
+import mmap
+import os
+import threading
+import time
+import numpy as np
+
+from .history import TELEMETRY_WIDTH, fill_sample
+
+JOURNAL_MAGIC = b'KTLJ'
+JOURNAL_VERSION = 1
+
+# record flags
+FLAG_OSC = 0x1
+FLAG_RPT_ON = 0x2
+
+JOURNAL_HEADER = np.dtype([
+  ('magic', 'S4'), ('version', '<u4'), ('record_size', '<u4'), ('capacity', '<u4'),
+  ('count', '<u4'), ('reserved', '<u4'), ('t_first', '<f8'), ('t_last', '<f8'),
+  ('pad', 'u1', 24)])
+
+JOURNAL_RECORD = np.dtype([('t', '<f8'), ('flags', '<u4'), ('reserved', '<u4'),
+                           ('data', '<f4', (TELEMETRY_WIDTH,))])
+
+class JournalTooLarge(ValueError):
+  pass
+
+def _window(records, start=None, end=None):
+  # view of the records with t in [start, end], records are in time order
+  t = records['t']
+  lo = 0 if start is None else np.searchsorted(t, start, side='left')
+  hi = len(t) if end is None else np.searchsorted(t, end, side='right')
+  return records[lo:hi]
+
+def _read_header(path):
+  # header of a segment file without mapping it
+  header = np.fromfile(path, dtype=JOURNAL_HEADER, count=1)
+  if len(header) != 1 or header['magic'][0] != JOURNAL_MAGIC:
+    raise ValueError('{} is not a telemetry journal'.format(path))
+  return header[0]
+
+class JournalSegment():
+  """One preallocated, memory-mapped segment file of fixed-size records.
+
+  With capacity a new segment is created, otherwise an existing one is
+  mapped read-only, or for appending with writable.
+  """
+
+  def __init__(self, path, capacity=None, writable=False):
+    self.path = path
+    writable = writable or capacity is not None
+    if capacity is not None:
+      # new segment, reserve the blocks up front so appends never grow the file
+      size = JOURNAL_HEADER.itemsize + capacity * JOURNAL_RECORD.itemsize
+      fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+      try:
+        if hasattr(os, 'posix_fallocate'):
+          os.posix_fallocate(fd, 0, size)
+        else:
+          os.ftruncate(fd, size)
+      finally:
+        os.close(fd)
+    with open(path, 'r+b' if writable else 'rb') as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+    self.header = np.frombuffer(self._mm, dtype=JOURNAL_HEADER, count=1)
+    if capacity is not None:
+      self.header[0] = (JOURNAL_MAGIC, JOURNAL_VERSION, JOURNAL_RECORD.itemsize, capacity, 0, 0, 0., 0., 0)
+    elif (self.header['magic'][0] != JOURNAL_MAGIC or self.header['version'][0] != JOURNAL_VERSION or
+          self.header['record_size'][0] != JOURNAL_RECORD.itemsize or
+          len(self._mm) < JOURNAL_HEADER.itemsize + int(self.header['capacity'][0]) * JOURNAL_RECORD.itemsize):
+      self.close()
+      raise ValueError('{} is not a version {} telemetry journal'.format(path, JOURNAL_VERSION))
+    self.capacity = int(self.header['capacity'][0])
+    self.records = np.frombuffer(self._mm, dtype=JOURNAL_RECORD, count=self.capacity, offset=JOURNAL_HEADER.itemsize)
+
+  @property
+  def count(self):
+    return int(self.header['count'][0])
+
+  def full(self):
+    return self.count >= self.capacity
+
+  def append(self, t, flags, **fields):
+    n = self.count
+    self.records['t'][n] = t
+    self.records['flags'][n] = flags
+    fill_sample(self.records['data'][n], **fields)
+    # publish the record only after it is written
+    if n == 0:
+      self.header['t_first'] = t
+    self.header['t_last'] = t
+    self.header['count'] = n + 1
+
+  def read(self, start=None, end=None):
+    return _window(self.records[:self.count], start, end).copy()
+
+  def flush(self):
+    self._mm.flush()
+
+  def close(self):
+    self.header = None
+    self.records = None
+    try:
+      self._mm.close()
+    except BufferError:
+      # a reader still holds a view, the map is released with it
+      pass
+
+class TelemetryJournal():
+  """Append-only on-disk telemetry log made of rotating memory-mapped segments.
+
+  Appends are plain stores into the mapped segment; dirty pages are pushed
+  with an msync of that segment at most every flush_interval seconds, never
+  a global sync. After a restart appends continue in the newest segment
+  unless it is full or of another layout, so restarts do not rotate
+  history out.
+  """
+
+  def __init__(self, directory, segment_records=86400, max_segments=8, flush_interval=60.):
+    self._dir = directory
+    self._segment_records = segment_records
+    self._max_segments = max_segments
+    self._flush_interval = flush_interval
+    self._lock = threading.Lock()
+    self._active = None
+    self._last_flush = time.monotonic()
+    os.makedirs(directory, exist_ok=True)
+
+  def _segment_paths(self):
+    return sorted(glob.glob(os.path.join(self._dir, 'telemetry-*.kjl')))
+
+  def _rotate(self):
+    # must hold self._lock
+    paths = self._segment_paths()
+    seq = int(os.path.basename(paths[-1])[10:-4]) + 1 if paths else 0
+    if self._active is not None:
+      self._active.flush()
+      self._active.close()
+    self._active = JournalSegment(os.path.join(self._dir, 'telemetry-{:08d}.kjl'.format(seq)), self._segment_records)
+    for path in self._segment_paths()[:-self._max_segments]:
+      os.remove(path)
+
+  def _resume(self):
+    # reopen the newest segment for appending, must hold self._lock
+    paths = self._segment_paths()
+    if not paths:
+      return
+    try:
+      seg = JournalSegment(paths[-1], writable=True)
+    except (ValueError, OSError):
+      # another layout or version, a new segment is started next to it
+      return
+    if seg.full():
+      seg.close()
+      return
+    self._active = seg
+
+  def append(self, t, flags=0, **fields):
+    with self._lock:
+      if self._active is None:
+        self._resume()
+      if self._active is None or self._active.full():
+        self._rotate()
+      self._active.append(t, flags, **fields)
+      if time.monotonic() - self._last_flush > self._flush_interval:
+        self._active.flush()
+        self._last_flush = time.monotonic()
+
+  def flush(self):
+    with self._lock:
+      if self._active is not None:
+        self._active.flush()
+        self._last_flush = time.monotonic()
+
+  def close(self):
+    with self._lock:
+      if self._active is not None:
+        self._active.flush()
+        self._active.close()
+        self._active = None
+
+  def read(self, start=None, end=None, limit=None):
+    """Return the records in [start, end] as a JOURNAL_RECORD array, oldest first.
+
+    Raises JournalTooLarge when more than limit records match, before
+    anything is copied. Only the segment list and a view of the active
+    segment are taken under the lock, appends are not held up by the copy.
+    Segments whose header t_first/t_last lie outside [start, end] are not
+    mapped at all.
+    """
+    with self._lock:
+      paths = self._segment_paths()
+      active_path = None if self._active is None else self._active.path
+      # the view keeps the mapping alive even if the segment is rotated out meanwhile
+      active = None if self._active is None else self._active.records[:self._active.count]
+    opened = []
+    try:
+      windows = []
+      for path in paths:
+        if path == active_path:
+          records = active
+        else:
+          try:
+            header = _read_header(path)
+            if (header['count'] == 0 or (start is not None and header['t_last'] < start) or
+                (end is not None and header['t_first'] > end)):
+              continue
+            seg = JournalSegment(path)
+          except (ValueError, OSError):
+            # removed by a rotation since the listing
+            continue
+          opened.append(seg)
+          records = seg.records[:seg.count]
+        win = _window(records, start, end)
+        if len(win):
+          windows.append(win)
+      total = sum(len(win) for win in windows)
+      if limit is not None and total > limit:
+        raise JournalTooLarge('{} records in the window, at most {} can be read at once'.format(total, limit))
+      data = np.concatenate(windows) if windows else np.zeros(0, dtype=JOURNAL_RECORD)
+    finally:
+      # drop the views before unmapping the segments opened here
+      windows = records = win = active = None
+      for seg in opened:
+        seg.close()
+    return data
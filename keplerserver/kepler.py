@@ -1,15 +1,206 @@
 import numpy as np
-from keplerrpc import KeplerRPC
+import collections
+import copy
+import hashlib
+import logging
+import threading
+import time
+import os
+try:
+  from keplerrpc import KeplerRPC
+except ImportError:
+  # only the simulated transport (sim.SimKeplerRPC) is usable
+  KeplerRPC = None
+
+from .serialworker import SerialWorker, PRIO_CONTROL, PRIO_CAPTURE, PRIO_STATUS
+from .jobs import run_tool
+from .trace import TraceWriter
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# slow-changing registers served from the read-through cache,
+# method -> ttl in seconds (None keeps the value until invalidated)
+CACHE_TTL = {
+  'get_boxcal_data': None,
+  'dl_atten': 60.,
+  'ul_atten': 60.,
+  'center_freq': 60.,
+  'tdd_mode': 60.,
+  'mode': 60.,
+  'tuner_lowgain_mode': 60.,
+}
+
+# calls that change module state beyond the register of the same name
+CACHE_FLUSH_ALL = ['tuner_reset', 'bootloader']
+
+# bulk transfers, queued behind config writes but ahead of status polls
+CAPTURE_METHODS = ['read_capture', 'load_pilot', 'canxfir_get', 'canxfir_load']
+
+CAPTURE_FORMATS = ['legacy', 'raw', 'complex64']
+
+# longest an stm32loader run may take (s)
+FLASH_TIMEOUT = 300.
+
+# default per-request timeout (s) by priority
+CALL_TIMEOUT = {PRIO_CONTROL: 30., PRIO_CAPTURE: 30., PRIO_STATUS: 10.}
 
 class Kepler():
 
-  def __init__(self, port="/dev/ttyUSB1"):
+  def __init__(self, port="/dev/ttyUSB1", cache_ttl=CACHE_TTL, cli=None, trace=None):
+    """cli is the RPC transport, a KeplerRPC on port unless one (e.g. sim.SimKeplerRPC or
+    trace.ReplayKeplerRPC) is passed. With trace every call is recorded to that file."""
     self._port = port
-    self.cli = KeplerRPC(port)
+    if cli is None:
+      if KeplerRPC is None:
+        raise RuntimeError('keplerrpc is not installed')
+      cli = KeplerRPC(port)
+    self.cli = cli
+    # KeplerRPC is not safe for concurrent use, every transaction on the
+    # link runs on this worker thread
+    self._worker = SerialWorker(name='serial-worker-{}'.format(os.path.basename(port)))
+    self._worker.start()
+    self._cache_lock = threading.Lock()
+    self._cache_ttl = dict(cache_ttl)
+    self._cache = {}
+    self._cache_hits = collections.Counter()
+    self._cache_misses = collections.Counter()
+    # CANX FIR taps per tdd slot, tdd -> (taps, version, etag)
+    self._canxfir_cache = {}
+    # last seen (version, etag) per tdd slot, kept across invalidation so versions only grow
+    self._canxfir_versions = {}
+    # last reply per method (args, ret, latency), written at the head of a
+    # trace started at runtime so a replay can answer the init-time calls
+    self._last_replies = {}
+    self._trace = None
+    if trace is not None:
+      self.start_trace(trace)
+
+  def start_trace(self, path):
+    """Record every call on the link to path (see trace.TraceWriter), replacing a running trace.
+
+    The trace starts with the last reply to each method seen so far, so one
+    started at runtime still replays a server start (vendor, config getters).
+    """
+    writer = TraceWriter(path, port=self._port)
+    with self._cache_lock:
+      seeds = list(self._last_replies.items())
+    for method, (args, ret, latency) in seeds:
+      writer.record_seed(method, args, ret, latency)
+    old, self._trace = self._trace, writer
+    if old is not None:
+      old.close()
+    logger.info('recording RPC trace to %s', path)
+
+  def stop_trace(self):
+    """Stop recording, returns the number of recorded calls."""
+    writer, self._trace = self._trace, None
+    if writer is None:
+      return 0
+    writer.close()
+    return writer.records
+
+  def invalidate_cache(self, method=None):
+    with self._cache_lock:
+      if method is None:
+        self._cache.clear()
+        self._canxfir_cache.clear()
+      else:
+        self._cache.pop(method, None)
+
+  def cache_stats(self):
+    with self._cache_lock:
+      return {'hits': sum(self._cache_hits.values()), 'misses': sum(self._cache_misses.values()),
+              'methods': {m: {'hits': self._cache_hits[m], 'misses': self._cache_misses[m],
+                              'cached': m in self._cache} for m in self._cache_ttl}}
+
+  def _cache_lookup(self, method, args):
+    # returns (True, value) on a hit, must hold self._cache_lock
+    if args or method not in self._cache_ttl:
+      return False, None
+    entry = self._cache.get(method)
+    if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+      self._cache_hits[method] += 1
+      return True, copy.copy(entry[1])
+    self._cache_misses[method] += 1
+    return False, None
+
+  def _cache_update(self, method, args, ret):
+    # must hold self._cache_lock
+    if method == 'canxfir_load' and args:
+      # taps loaded around canxfir_load_raw (batch or generic dispatch)
+      self._canxfir_cache.pop(args[0], None)
+    if method in CACHE_FLUSH_ALL:
+      self._cache.clear()
+    elif args:
+      # setter, the next read goes to the module
+      self._cache.pop(method, None)
+    elif method in self._cache_ttl:
+      ttl = self._cache_ttl[method]
+      self._cache[method] = (None if ttl is None else time.monotonic() + ttl, copy.copy(ret))
+
+  def queue_depth(self):
+    return self._worker.queue_depth()
+
+  def _priority(self, method, args):
+    if method in CAPTURE_METHODS:
+      return PRIO_CAPTURE
+    if args or method in CACHE_FLUSH_ALL:
+      return PRIO_CONTROL
+    return PRIO_STATUS
+
+  def _run(self, fn, priority, timeout=None):
+    """Run fn on the serial worker, timeout defaults to CALL_TIMEOUT for the priority."""
+    return self._worker.run(fn, priority, CALL_TIMEOUT[priority] if timeout is None else timeout)
+
+  def _cli_call(self, method, *args):
+    # runs on the serial worker, every KeplerRPC call goes through here
+    tx = sum(len(memoryview(a).cast('B')) for a in args if isinstance(a, (bytes, bytearray, memoryview)))
+    if tx:
+      metrics.rpc_bytes.inc('tx', amount=tx)
+    t0 = time.perf_counter()
+    ret = None
+    try:
+      ret = self.cli.call(method, *args)
+    except Exception as e:
+      metrics.rpc_errors.inc(method)
+      ret = e
+      raise
+    finally:
+      latency = time.perf_counter() - t0
+      metrics.rpc_latency.observe(latency, method)
+      metrics.rpc_calls.inc(method)
+      if self._trace is not None:
+        self._trace.record(method, args, ret, latency)
+    if isinstance(ret, (bytes, bytearray)):
+      metrics.rpc_bytes.inc('rx', amount=len(ret))
+    self._keep_reply(method, args, ret, latency)
+    return ret
+
+  def _keep_reply(self, method, args, ret, latency):
+    # bulk transfers are left out, a replay answers them from the method's recorded calls
+    if method in CAPTURE_METHODS or isinstance(ret, (bytes, bytearray)) or \
+       any(isinstance(a, (bytes, bytearray, memoryview)) for a in args):
+      return
+    with self._cache_lock:
+      self._last_replies[method] = (args, ret, latency)
+
+  def _transact(self, method, args):
+    # runs on the serial worker
+    ret = self._cli_call(method, *args)
+    with self._cache_lock:
+      self._cache_update(method, args, ret)
+    return ret
 
-  def call(self, method, *args):
-    ret = self.cli.call(method, *args)
-    print("Kepler: call {} args {} ret {}".format(method, args, ret))
+  def call(self, method, *args, priority=None, timeout=None):
+    with self._cache_lock:
+      hit, ret = self._cache_lookup(method, args)
+    if hit:
+      return ret
+    if priority is None:
+      priority = self._priority(method, args)
+    ret = self._run(lambda: self._transact(method, args), priority, timeout)
+    logger.debug("call %s args %s ret %s", method, args, ret)
     #if isinstance(ret, list):
     #    for i in range(len(ret)):
     #        if isinstance(ret[i], int) and ret[i] > 2**31:
@@ -19,44 +210,265 @@ class Kepler():
 
     return ret
 
+  def call_many(self, calls, priority=None, timeout=None, return_exceptions=False):
+    """Run a list of (method, args) requests back to back, returns the results in order.
+
+    The whole batch is issued as one job on the serial worker, so a caller
+    pays the queueing/turnaround once instead of per register. If the
+    transport can frame several requests together (cli.call_many, returning
+    one reply or exception per request, e.g. sim.SimKeplerRPC) the batch
+    goes out as one pipelined transaction. KeplerRPC has no such call, on
+    the module every request is still its own round-trip.
+
+    With return_exceptions, a failing request puts its exception in the
+    result list instead of raising.
+    """
+    calls = [(c[0], tuple(c[1]) if len(c) > 1 else ()) for c in calls]
+    rets = [None] * len(calls)
+    with self._cache_lock:
+      # serve cached getters, unless an earlier write in this batch touches them
+      pending = []
+      written = set()
+      for i, (method, args) in enumerate(calls):
+        if args or method in CACHE_FLUSH_ALL:
+          written.update(self._cache_ttl if method in CACHE_FLUSH_ALL else [method])
+        elif method not in written:
+          hit, ret = self._cache_lookup(method, args)
+          if hit:
+            rets[i] = ret
+            continue
+        pending.append(i)
+    if not pending:
+      return rets
+    if priority is None:
+      priority = min(self._priority(*calls[i]) for i in pending)
+
+    def transact():
+      if not hasattr(self.cli, 'call_many'):
+        # one round-trip per request, the cache follows every reply as it
+        # arrives so an error part-way through leaves no stale entries for
+        # writes that already went out
+        replies = []
+        for i in pending:
+          try:
+            replies.append(self._transact(*calls[i]))
+          except Exception as e:
+            with self._cache_lock:
+              self._cache.pop(calls[i][0], None)
+            if not return_exceptions:
+              raise
+            replies.append(e)
+        return replies
+
+      t0 = time.perf_counter()
+      try:
+        replies = list(self.cli.call_many([calls[i] for i in pending]))
+      except Exception:
+        # the link failed, any of the requests may have reached the module
+        metrics.rpc_errors.inc('call_many')
+        with self._cache_lock:
+          for i in pending:
+            self._cache.pop(calls[i][0], None)
+        raise
+      finally:
+        latency = time.perf_counter() - t0
+        metrics.rpc_latency.observe(latency, 'call_many')
+        metrics.rpc_calls.inc('call_many')
+      with self._cache_lock:
+        for i, ret in zip(pending, replies):
+          if isinstance(ret, Exception):
+            self._cache.pop(calls[i][0], None)
+          else:
+            self._cache_update(calls[i][0], calls[i][1], ret)
+      for i, ret in zip(pending, replies):
+        if isinstance(ret, Exception):
+          metrics.rpc_errors.inc(calls[i][0])
+        else:
+          self._keep_reply(calls[i][0], calls[i][1], ret, latency / len(pending))
+        if self._trace is not None:
+          # one pipelined transaction, its time is spread over the requests
+          self._trace.record(calls[i][0], calls[i][1], ret, latency / len(pending))
+      if not return_exceptions:
+        for ret in replies:
+          if isinstance(ret, Exception):
+            raise ret
+      return replies
+
+    if timeout is None:
+      # the batch is one job on the worker, every request gets its own allowance
+      timeout = CALL_TIMEOUT[priority] * len(pending)
+    for i, ret in zip(pending, self._run(transact, priority, timeout)):
+      rets[i] = ret
+    for i in pending:
+      logger.debug("call %s args %s ret %s", calls[i][0], calls[i][1], rets[i])
+    return rets
+
   def load_pilot(self, waveform):
-    ret = self.cli.call('pilot_enable',0)
-    dd = (waveform.real.astype(dtype='int16') + (waveform.imag.astype(dtype='int16')*2**16))
-    dd_b = dd.tobytes()
-    ret = self.cli.call('load_pilot',dd_b)
-    print("load_pilot : loaded {} samples : ret {}".format(len(dd_b), ret))
+    # complex -> interleaved int16 I/Q, one cast of the (re, im) view
+    waveform = np.ascontiguousarray(waveform)
+    dd = waveform.view(waveform.real.dtype).astype('int16')
+    return self.load_pilot_raw(memoryview(dd).cast('B'))
 
-    self.cli.call('pilot_enable',1)
+  def load_pilot_raw(self, buf):
+    """Load a pilot from a bytes-like buffer of little-endian interleaved int16 I/Q."""
+    buf = memoryview(buf).cast('B')
+    if len(buf) == 0 or len(buf) % 4 != 0:
+      raise ValueError('pilot must be a non-empty multiple of 4 bytes (int16 I/Q), got {}'.format(len(buf)))
+
+    def transact():
+      ret = self._cli_call('pilot_enable',0)
+      ret = self._cli_call('load_pilot',buf)
+      logger.info("load_pilot : loaded %d bytes : ret %s", len(buf), ret)
+
+      self._cli_call('pilot_enable',1)
+      return ret
+    t0 = time.perf_counter()
+    ret = self._run(transact, PRIO_CAPTURE)
+    metrics.op_latency.observe(time.perf_counter() - t0, 'load_pilot')
     return ret
 
   def canxfir_get(self, tdd):
-    data = self.cli.call('canxfir_get',tdd)
+    return self.canxfir_get_versioned(tdd)[0]
+
+  def canxfir_etag(self, tdd):
+    """ETag of the cached taps for tdd, None if they are not cached (no serial traffic)."""
+    with self._cache_lock:
+      entry = self._canxfir_cache.get(tdd)
+    return None if entry is None else entry[2]
+
+  def canxfir_get_versioned(self, tdd, refresh=False):
+    """Return (taps, version, etag) for tdd, reading the module only on a cache miss."""
+    with self._cache_lock:
+      entry = self._canxfir_cache.get(tdd)
+    if entry is not None and not refresh:
+      return entry
+    data = self._run(lambda: self._cli_call('canxfir_get',tdd), PRIO_CAPTURE)
     arr = np.frombuffer(data, dtype='float32')
-    return arr
+    return self._canxfir_store(tdd, arr)
+
+  def _canxfir_store(self, tdd, arr):
+    etag = hashlib.sha1(memoryview(arr).cast('B')).hexdigest()[:20]
+    with self._cache_lock:
+      version, prev_etag = self._canxfir_versions.get(tdd, (0, None))
+      if etag != prev_etag:
+        version += 1
+        self._canxfir_versions[tdd] = (version, etag)
+      entry = (arr, version, etag)
+      self._canxfir_cache[tdd] = entry
+    return entry
 
   def canxfir_load(self, tdd, data):
-    dd_b = data.tobytes()
-    print('canxfir_load : tdd {} data len {} dd_b {} bytes'.format(tdd, len(data), len(dd_b)))
-    ret = self.cli.call('canxfir_load',tdd,dd_b)
+    data = np.ascontiguousarray(data, dtype='<f4')
+    return self.canxfir_load_raw(tdd, memoryview(data).cast('B'))
+
+  def canxfir_load_raw(self, tdd, buf):
+    """Load CANX FIR taps from a bytes-like buffer of little-endian float32."""
+    buf = memoryview(buf).cast('B')
+    if len(buf) == 0 or len(buf) % 4 != 0:
+      raise ValueError('taps must be a non-empty multiple of 4 bytes (float32), got {}'.format(len(buf)))
+    logger.info('canxfir_load : tdd %s, %d taps', tdd, len(buf) // 4)
+    with self._cache_lock:
+      self._canxfir_cache.pop(tdd, None)
+    ret = self._run(lambda: self._cli_call('canxfir_load',tdd,buf), PRIO_CAPTURE)
+    # the module now holds exactly these taps
+    self._canxfir_store(tdd, np.frombuffer(bytes(buf), dtype='<f4'))
     return ret
     
-  def program_mcu(self, binfile):
+  def _enter_bootloader(self):
+    # runs on the serial worker
+    self.invalidate_cache()
     self.cli.call_noreply('bootloader')
+    if self._trace is not None:
+      self._trace.record('bootloader', (), None, 0.)
     time.sleep(0.5)
-    os.system('stm32loader -b 57600 -p {} -e -w -v {}'.format(self._port, binfile))
-    time.sleep(0.5)
-    os.system('stm32loader -p {} -g 0x08000000'.format(self._port))
+
+  def program_mcu(self, binfile, job=None):
+    """Flash binfile with stm32loader, progress and tool output go to job when given.
+
+    The serial worker is held for the bootloader and flash steps only, other
+    requests queue behind it and run as soon as the MCU is started again.
+    """
+    log = job.log if job is not None else logger.info
+    def transact():
+      if job is not None:
+        job.set_progress(0., 'bootloader')
+      self._enter_bootloader()
+      if job is not None:
+        job.set_progress(0.1, 'flash')
+      run_tool(['stm32loader', '-b', '57600', '-p', self._port, '-e', '-w', '-v', binfile], log, FLASH_TIMEOUT)
+      time.sleep(0.5)
+      if job is not None:
+        job.set_progress(0.9, 'start')
+      run_tool(['stm32loader', '-p', self._port, '-g', '0x08000000'], log, FLASH_TIMEOUT)
+    # no queue timeout, the flash itself is bounded by FLASH_TIMEOUT
+    self._worker.run(transact, PRIO_CONTROL)
     return '1'
 
-  def reset_mcu(self):
-    self.cli.call_noreply('bootloader')
-    time.sleep(0.5)
-    os.system('stm32loader -p {} -g 0x08000000'.format(self._port))
+  def reset_mcu(self, job=None):
+    log = job.log if job is not None else logger.info
+    def transact():
+      if job is not None:
+        job.set_progress(0., 'bootloader')
+      self._enter_bootloader()
+      if job is not None:
+        job.set_progress(0.5, 'start')
+      run_tool(['stm32loader', '-p', self._port, '-g', '0x08000000'], log, FLASH_TIMEOUT)
+    # as for program_mcu, the tool run is bounded by FLASH_TIMEOUT
+    self._worker.run(transact, PRIO_CONTROL)
     return '1'
 
-  def get_capture(self, group, length, triggered):
-    data = self.cli.call('read_capture', group, length, triggered)
+  def get_capture(self, group, length, triggered, fmt='legacy'):
+    """Read a capture buffer, fmt selects the returned representation.
+
+    'raw'       : memoryview over the RPC reply, interleaved int16 I/Q (no copy)
+    'complex64' : complex64 array (one float32 copy viewed as complex)
+    'legacy'    : complex128 array, as returned by earlier versions
+    """
+    if fmt not in CAPTURE_FORMATS:
+      raise ValueError('unknown capture format {}'.format(fmt))
+    t0 = time.perf_counter()
+    data = self._run(lambda: self._cli_call('read_capture', group, length, triggered), PRIO_CAPTURE)
+    metrics.op_latency.observe(time.perf_counter() - t0, 'get_capture')
+    if fmt == 'raw':
+      return memoryview(data)
     arr = np.frombuffer(data, dtype='int16')
+    if fmt == 'complex64':
+      return arr.astype('float32').view('complex64')
     ret = arr[0::2] + 1j*arr[1::2]
     return ret
 
+
+  def get_captures(self, captures, fmt='complex64'):
+    """Read several capture buffers back to back into one preallocated array.
+
+    captures is a list of (group, length, triggered). All reads run as one
+    job on the serial worker so nothing else is interleaved between them.
+    Returns (data, offsets): data holds the captures one after the other in
+    the fmt representation ('raw' is interleaved int16 I/Q, so twice as many
+    entries), capture i is data[offsets[i]:offsets[i+1]] in samples.
+    """
+    if fmt not in CAPTURE_FORMATS:
+      raise ValueError('unknown capture format {}'.format(fmt))
+    if not captures:
+      raise ValueError('no captures requested')
+    offsets = np.zeros(len(captures) + 1, dtype='int64')
+    offsets[1:] = np.cumsum([length for _, length, _ in captures])
+    if fmt == 'raw':
+      out = np.empty(2 * offsets[-1], dtype='int16')
+      iq = out
+    else:
+      out = np.empty(offsets[-1], dtype='complex64' if fmt == 'complex64' else 'complex128')
+      iq = out.view('float32' if fmt == 'complex64' else 'float64')
+
+    def transact():
+      for i, (group, length, triggered) in enumerate(captures):
+        data = np.frombuffer(self._cli_call('read_capture', group, length, triggered), dtype='int16')
+        if len(data) != 2 * length:
+          raise RuntimeError('capture group {} returned {} samples, expected {}'.format(group, len(data) // 2, length))
+        # converts in place, no intermediate per-group array
+        iq[2 * offsets[i]:2 * offsets[i + 1]] = data
+
+    t0 = time.perf_counter()
+    self._run(transact, PRIO_CAPTURE, CALL_TIMEOUT[PRIO_CAPTURE] * len(captures))
+    metrics.op_latency.observe(time.perf_counter() - t0, 'get_captures')
+    return out, offsets
@@ -0,0 +1,131 @@
+import bisect
+import threading
+
+# latency histogram bucket upper bounds (s)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+# TDD sync acquisition time bucket upper bounds (s)
+SYNC_BUCKETS = (0.25, 0.5, 1., 2., 5., 10., 20., 30., 60., 120.)
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labelstr(names, values, extra=None):
+  pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+  if extra is not None:
+    pairs.append('{}="{}"'.format(*extra))
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _fmt(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter():
+
+  def __init__(self, name, doc, labels=()):
+    self.name = name
+    self.doc = doc
+    self.labels = tuple(labels)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def inc(self, *labels, amount=1):
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} counter'.format(self.name)]
+    with self._lock:
+      for labels, value in sorted(self._values.items()):
+        lines.append('{}{} {}'.format(self.name, _labelstr(self.labels, labels), _fmt(value)))
+    return lines
+
+class Histogram():
+
+  def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.doc = doc
+    self.labels = tuple(labels)
+    self.buckets = tuple(buckets)
+    # labels -> [bucket counts..., sum, count]
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def observe(self, value, *labels):
+    i = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      entry = self._values.get(labels)
+      if entry is None:
+        entry = self._values[labels] = [0] * (len(self.buckets) + 2)
+      if i < len(self.buckets):
+        entry[i] += 1
+      entry[-2] += value
+      entry[-1] += 1
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} histogram'.format(self.name)]
+    with self._lock:
+      for labels, entry in sorted(self._values.items()):
+        cum = 0
+        for bound, n in zip(self.buckets, entry):
+          cum += n
+          lines.append('{}_bucket{} {}'.format(self.name, _labelstr(self.labels, labels, ('le', _fmt(bound))), cum))
+        lines.append('{}_bucket{} {}'.format(self.name, _labelstr(self.labels, labels, ('le', '+Inf')), entry[-1]))
+        lines.append('{}_sum{} {}'.format(self.name, _labelstr(self.labels, labels), repr(float(entry[-2]))))
+        lines.append('{}_count{} {}'.format(self.name, _labelstr(self.labels, labels), entry[-1]))
+    return lines
+
+class Callback():
+  """Metric read from a function at scrape time, fn returns a value or a {labels: value} dict."""
+
+  def __init__(self, name, doc, fn, kind='gauge', labels=()):
+    self.name = name
+    self.doc = doc
+    self.fn = fn
+    self.kind = kind
+    self.labels = tuple(labels)
+
+  def render(self):
+    lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} {}'.format(self.name, self.kind)]
+    values = self.fn()
+    if not isinstance(values, dict):
+      values = {(): values}
+    for labels, value in sorted(values.items()):
+      lines.append('{}{} {}'.format(self.name, _labelstr(self.labels, labels), _fmt(value)))
+    return lines
+
+class Registry():
+
+  def __init__(self):
+    self._metrics = {}
+    self._lock = threading.Lock()
+
+  def register(self, metric):
+    with self._lock:
+      self._metrics[metric.name] = metric
+    return metric
+
+  def render(self):
+    """Prometheus text exposition format."""
+    with self._lock:
+      metrics = list(self._metrics.values())
+    lines = []
+    for metric in metrics:
+      try:
+        lines.extend(metric.render())
+      except Exception:
+        # a broken callback must not take the whole scrape down
+        continue
+    return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+rpc_calls = REGISTRY.register(Counter('kepler_rpc_calls_total', 'KeplerRPC calls by method', ['method']))
+rpc_errors = REGISTRY.register(Counter('kepler_rpc_errors_total', 'KeplerRPC calls that raised, by method', ['method']))
+rpc_latency = REGISTRY.register(Histogram('kepler_rpc_latency_seconds', 'Time on the serial link per KeplerRPC call', ['method']))
+rpc_bytes = REGISTRY.register(Counter('kepler_rpc_payload_bytes_total', 'Binary payload bytes moved over the serial link', ['direction']))
+op_latency = REGISTRY.register(Histogram('kepler_op_latency_seconds', 'Kepler bulk operation latency including queueing', ['op']))
+http_requests = REGISTRY.register(Counter('kepler_http_requests_total', 'HTTP requests by route and status', ['route', 'method', 'status']))
+http_latency = REGISTRY.register(Histogram('kepler_http_request_latency_seconds', 'HTTP request handling time by route', ['route']))
+tdd_time_to_sync = REGISTRY.register(Histogram('kepler_tdd_time_to_sync_seconds', 'Time from a TDD sync search start to lock, by how the cell was found', ['method'], buckets=SYNC_BUCKETS))
+tdd_sync_timeouts = REGISTRY.register(Counter('kepler_tdd_sync_timeouts_total', 'TDD sync searches that did not lock in time', ['method']))
@@ -1,29 +1,49 @@
-import numpy as np
-import pickle
 import time
 import os
-import datetime
+import threading
+import logging
+
+from .history import TelemetryHistory
+from .journal import FLAG_OSC, FLAG_RPT_ON
+from .analysis import boxcal_conversions
+from .configstore import ConfigStore
+from .acquisition import SyncAcquisition
+from .status import new_status, set_status, set_power_status, render_kepler_status, render_tdd_status, LazyStatus
+
+logger = logging.getLogger(__name__)
+
+# after the saved config restarts the TDD sync, init waits at most this long
+# (s) for the search to settle before the first status fetch
+SYNC_SETTLE_TIMEOUT = 5.
+SYNC_POLL_INTERVAL = 0.2
 
 class Repeater():
 
-  def __init__(self, keplerobj):
+  def __init__(self, keplerobj, journal=None, savefile='.kepler_server_config.json', sync_cache=None):
     self._kepler = keplerobj
+    self._journal = journal
     self._curconfig = {}
     self._kepler_status = {}
     self._tdd_status = {}
-    self._adcdac_pwr_history = [[] for i in range(12)]
-    self._pwr_history_len = 30
-    self._savefile = '.kepler_server_config.cfg'
+    self._pwr_history_len = 3600
+    self._history = TelemetryHistory(capacity=self._pwr_history_len)
+    # configs saved by earlier versions were pickled next to it with a .cfg suffix
+    self._config_store = ConfigStore(savefile, legacy_path=os.path.splitext(savefile)[0] + '.cfg')
+    # last locked cell per center frequency / bandwidth, kept next to the config
+    self._acq = SyncAcquisition(keplerobj, sync_cache or os.path.splitext(savefile)[0] + '.sync.json')
     self.MIN_DIG_GAIN = -10.
     self._prev_mode = None
     self._counter = 0
     self._donorrx_dbm2dbfs = 0.
     self._tstat_h = {}
-    self._tstat_v = {}
     self._kstat_h = {}
-    self._kstat_v = {}
+    self._status = new_status()
     self._bw_values = [5,10,15,20,25,30,40,50,60,70,80,90,100,200]
     self._prev_uptime = 0.
+    self._needs_init = False
+    # guards the status/config dicts, held by the status sampler while it
+    # refreshes and by request threads while they change the config
+    self.lock = threading.RLock()
     self.init()
 
   def init(self):
@@ -57,16 +77,7 @@ class Repeater():
 
     self._kepler.call('vendor', 1)
 
-    boxcal_data = self._kepler.call('get_boxcal_data')
-    dl_atten = self._kepler.call('dl_atten')
-    ul_atten = self._kepler.call('ul_atten')
-    donorrx_dbm2dbfs = (boxcal_data[8] - np.array(dl_atten[2:4])/4) + boxcal_data[0:2]
-    donortx_dbfs2dbm = boxcal_data[2:4]
-    serverrx_dbm2dbfs = (boxcal_data[9] - np.array(ul_atten[2:4])/4) + boxcal_data[4:6]
-    servertx_dbfs2dbm = boxcal_data[6:8]
-    analog_gain = max(np.add(donorrx_dbm2dbfs, servertx_dbfs2dbm))
-    self._analog_gain = analog_gain
-    print("analog gain : {}".format(analog_gain))
+    self._update_analog_gain()
 
      # do initial boot-up things
     self.fetch_curconfig()
@@ -75,12 +86,15 @@ class Repeater():
     except:
         saved_config = None
     if saved_config != None:
-      print('Found saved config, applying..')
+      logger.info('Found saved config, applying..')
+      # only registers that differ from the live module are written
       try:
-          self.change_config(saved_config)
-      except:
-          pass
-      time.sleep(5)
+          plan = self.change_config(saved_config)
+      except Exception as e:
+          logger.warning('Applying saved config failed : %s', e)
+          plan = []
+      if ('tdd_sync_stop', ()) in plan:
+        self.wait_sync(SYNC_SETTLE_TIMEOUT)
     self.fetch_kepler_status()
     self.fetch_tdd_status()
 
@@ -88,19 +102,22 @@ class Repeater():
     return self._curconfig
 
   def fetch_curconfig(self):
-    self._curconfig['center_freq'] = self._kepler.call('center_freq')/1e6
+    (center_freq, rpt_mode, gain, rpt_params, pa_en, dl_atten, ul_atten, tdd_mode, lowgain_mode,
+     chan_byp, bank_sel, search_freq, tdd_schedule) = self._kepler.call_many([
+      ('center_freq',), ('mode',), ('gain',), ('repeater_params',), ('pa_enabled',),
+      ('dl_atten',), ('ul_atten',), ('tdd_mode',), ('tuner_lowgain_mode',),
+      ('bypass_chan_fir',), ('chan_fir_bank_sel',), ('tdd_sync_search_freq',), ('tdd_frame_schedule',)])
+
+    self._curconfig['center_freq'] = center_freq/1e6
 
-    rpt_mode = self._kepler.call('mode')
     if rpt_mode[1] == 0:
         # manual gain
-        self._curconfig['target_gain'] = int(self._kepler.call('gain') + self._analog_gain)
+        self._curconfig['target_gain'] = int(gain + self._analog_gain)
     else:
         # auto gain
-        rpt_params = self._kepler.call('repeater_params')
         self._curconfig['target_gain'] = int(rpt_params[0] + self._analog_gain)
 
 #print('Fetching Curconfig : target gain {} analog gain {}'.format(self._curconfig['target_gain'], self._analog_gain))
-    pa_en = self._kepler.call('pa_enabled')
     self._curconfig['rpt_on'] = 1 if pa_en[0] > 0 or pa_en[1] > 0 else 0 
 
     if self._curconfig['rpt_on'] == 0 and self._prev_mode != None:
@@ -110,50 +127,35 @@ class Repeater():
       self._curconfig['canx_on'] = rpt_mode[0]
       self._curconfig['agc_on'] = rpt_mode[1]
 
-    dl_atten = self._kepler.call('dl_atten')
     self._curconfig['dl_rx_1'] = dl_atten[2]
     self._curconfig['dl_rx_2'] = dl_atten[3]
 
-    ul_atten = self._kepler.call('ul_atten')
     self._curconfig['ul_rx_1'] = ul_atten[2]
     self._curconfig['ul_rx_2'] = ul_atten[3]
 
-    tdd_mode = self._kepler.call('tdd_mode')
     if tdd_mode[0] == 0:
         self._curconfig['tdd_mode'] = 1
     if tdd_mode[0] == 1:
         self._curconfig['tdd_mode'] = 2+tdd_mode[1]
 
-    lowgain_mode = self._kepler.call('tuner_lowgain_mode')
 #print("lowgain_mode : {}".format(lowgain_mode))
     if lowgain_mode == 0:
         self._curconfig['lowgain_mode'] = 1
     if lowgain_mode == 1:
         self._curconfig['lowgain_mode'] = 2
 
-    chan_byp = self._kepler.call('bypass_chan_fir')
-    bank_sel = self._kepler.call('chan_fir_bank_sel')
 #bank_sel_names = ["5", "10", "15", "20", "25", "30", "40", "50", "60", "70", "80", "90", "100", "200"]
-    if chan_byp == 1:
-      self._curconfig['rfbw'] = 999
-      self._curconfig['chan_fir_byp'] = "selected"
-      for i in range(14):
-        self._curconfig['chan_fir_{}'.format(i)] = ""
-    else:
-      self._curconfig['rfbw'] = self._bw_values[bank_sel]
-      for i in range(14):
-        self._curconfig['chan_fir_{}'.format(i)] = "selected" if self._curconfig['rfbw'] == self._bw_values[i] else ""
-      self._curconfig['chan_fir_byp'] = ""
+    self._curconfig['rfbw'] = 999 if chan_byp == 1 else self._bw_values[bank_sel]
+    self._set_rfbw_fields(self._curconfig)
 
 #    tdd_band, tdd_arfcn = self._tdd.get_band_arfcn()
 #    self._curconfig['band'] = tdd_band
 #    self._curconfig['arfcn'] = tdd_arfcn
-    ssb_arfcn, freq_start, freq_stop, freq_step = self._kepler.call('tdd_sync_search_freq')
-    self._curconfig['arfcn'] = 0 if freq_step > 0 else ssb_arfcn
+    ssb_arfcn, freq_start, freq_stop, freq_step = search_freq
+    # a targeted search on the cached cell is not a pinned arfcn
+    self._curconfig['arfcn'] = 0 if freq_step > 0 or ssb_arfcn == self._acq.speculative_arfcn else ssb_arfcn
 
 #    tdd_status = self._tdd.read_status_simple()
-    tdd_schedule = self._kepler.call('tdd_frame_schedule')
-
     self._curconfig['slot1_dl'] = tdd_schedule[0]
     self._curconfig['slot1_ul'] = tdd_schedule[1]
     self._curconfig['slot2_dl'] = tdd_schedule[2]
@@ -163,208 +165,210 @@ class Repeater():
     self._curconfig['ssf_symbols_ul'] = tdd_schedule[6]
     self._curconfig['tdd_blanking'] = tdd_schedule[7]
 
-  def change_config(self, newconfig):
+  # keys that make up the tdd_frame_schedule register
+  SCHEDULE_KEYS = ['slot1_dl','slot1_ul','slot2_dl','slot2_ul','ssf_symbols_dl','ssf_symbols_gp','ssf_symbols_ul','tdd_blanking']
+
+  def _set_rfbw_fields(self, config):
+    # selection state of the bandwidth drop-down
+    if config['rfbw'] == 999:
+      config['chan_fir_byp'] = "selected"
+      for i in range(14):
+        config['chan_fir_{}'.format(i)] = ""
+    else:
+      for i in range(14):
+        config['chan_fir_{}'.format(i)] = "selected" if config['rfbw'] == self._bw_values[i] else ""
+      config['chan_fir_byp'] = ""
+
+  def plan_config(self, newconfig):
+    """Diff newconfig against the current config and build the command plan.
+
+    Returns (plan, desired). plan is an ordered list of steps, either
+    (method, args) register writes or callables for read-modify-write
+    sequences; every register is written at most once and the TDD sync is
+    restarted at most once. desired is the config after the plan ran.
+    """
+    cur = self._curconfig
+    desired = dict(cur)
     for k, v in newconfig.items():
-      if k in ['center_freq', 'rpt_on', 'canx_on', 'agc_on','gain']:
-        continue
-      if self._curconfig[k] != v:
-        if k == 'dl_rx_1' or k == 'dl_rx_2':
-          print('DL Atten RX : {}/{} -> {}/{}'.format(self._curconfig['dl_rx_1'], self._curconfig['dl_rx_2'], newconfig['dl_rx_1'], newconfig['dl_rx_2']))
-          self._curconfig['dl_rx_1'] = int(newconfig['dl_rx_1'])
-          self._curconfig['dl_rx_2'] = int(newconfig['dl_rx_2'])
-          self._kepler.call('dl_atten', 100, 100, int(self._curconfig['dl_rx_1']), int(self._curconfig['dl_rx_2']))
-        if k == 'ul_rx_1' or k == 'ul_rx_2':
-          print('UL Atten RX : {}/{} -> {}/{}'.format(self._curconfig['ul_rx_1'], self._curconfig['ul_rx_2'], newconfig['ul_rx_1'], newconfig['ul_rx_2']))
-          self._curconfig['ul_rx_1'] = int(newconfig['ul_rx_1'])
-          self._curconfig['ul_rx_2'] = int(newconfig['ul_rx_2'])
-          self._kepler.call('ul_atten', 100, 100, int(self._curconfig['ul_rx_1']), int(self._curconfig['ul_rx_2']))
-        if k == 'tdd_mode':
-          print('TDD Mode : {} -> {}'.format(self._curconfig[k], v))
-          self._curconfig[k] = int(v)
-          if self._curconfig[k] == 1:
-            # HW TDD
-            self._kepler.call('tdd_mode', 0, 1)
-          elif self._curconfig[k] == 2:
-            # DL only
-            self._kepler.call('tdd_mode', 1, 0)
-          elif self._curconfig[k] == 3:
-            # UL only
-            self._kepler.call('tdd_mode', 1, 1)
-          else:
-            raise RuntimeError('????')
-
-        if k == 'lowgain_mode':
-          print('LowGain Mode : {} -> {}'.format(self._curconfig[k], v))
-          self._curconfig[k] = int(v)
-          if self._curconfig[k] == 1:
-            # Lowgain Mode OFF
-            self._kepler.call('tuner_lowgain_mode', 0)
-          elif self._curconfig[k] == 2:
-            # Lowgain Mode ON
-            self._kepler.call('tuner_lowgain_mode', 1)
-          else:
-            raise RuntimeError('????')
-
-        if k == 'rfbw':
-#print("!!!!!!!!!!!!!!!!! rfbw {}".format(v))
-          self._curconfig[k] = v
-          if v == 999:
-            self._kepler.call('bypass_chan_fir',1)
-            self._curconfig['chan_fir_byp'] = "selected"
-            for i in range(14):
-              self._curconfig['chan_fir_{}'.format(i)] = ""
-          else:
-            self._kepler.call('bypass_chan_fir',0)
-            self._kepler.call('chan_fir_bank_sel', self._bw_values.index(v))
-            for i in range(14):
-              self._curconfig['chan_fir_{}'.format(i)] = "selected" if self._curconfig['rfbw'] == self._bw_values[i] else ""
-            self._curconfig['chan_fir_byp'] = ""
-          self._kepler.call('tdd_sync_stop')
-          try:
-            if self._curconfig['arfcn'] == 0:
-              if self._curconfig['rfbw'] == 999:
-                self._kepler.call('tdd_sync_start_search',6,1)
-              else:
-                self._kepler.call('tdd_sync_start_search',6,1, self._curconfig['center_freq']*1e6 - self._curconfig['rfbw']*1e6/2, self._curconfig['center_freq']*1e6 + self._curconfig['rfbw']*1e6/2)
-            else:
-              self._kepler.call('tdd_sync_start_search_arfcn',6,1,self._curconfig['arfcn'])
-          except:
-            pass
-
-
-        if k in ['arfcn','slot1_ul','slot1_dl','slot2_ul','slot2_dl','ssf_symbols_ul','ssf_symbols_gp','ssf_symbols_dl', 'tdd_blanking']:
-          for item in ['arfcn','slot1_ul','slot1_dl','slot2_ul','slot2_dl','ssf_symbols_ul','ssf_symbols_gp','ssf_symbols_dl', 'tdd_blanking']:
-            print('{} : {} -> {}'.format(item, self._curconfig[item], newconfig[item]))
-            if item == 'tdd_blanking':
-              self._curconfig[item] = newconfig[item]
-            else:
-              self._curconfig[item] = int(newconfig[item])
-#          sync_config = '0{:X}0{:X}0{:X}0{:X}0{:X}0{:X}0{:X}'.format(  \
-#              self._curconfig['slot1_ul'],self._curconfig['slot1_dl'], \
-#              self._curconfig['slot2_ul'],self._curconfig['slot2_dl'], \
-#              self._curconfig['ssf_symbols_ul'],self._curconfig['ssf_symbols_gp'], \
-#              self._curconfig['ssf_symbols_dl'])
-#          self._tdd.config(self._curconfig['band'], self._curconfig['arfcn'], sync_config)
-          print("tdd_blanking : {}, len {}".format(self._curconfig['tdd_blanking'], len(self._curconfig['tdd_blanking'])))
-          if len(self._curconfig['tdd_blanking']) == 0:
-            self._kepler.call('tdd_frame_schedule',  
-              self._curconfig['slot1_dl'],self._curconfig['slot1_ul'], \
-              self._curconfig['slot2_dl'],self._curconfig['slot2_ul'], \
-              self._curconfig['ssf_symbols_dl'],self._curconfig['ssf_symbols_gp'], \
-              self._curconfig['ssf_symbols_ul'])
-          else:
-            self._kepler.call('tdd_frame_schedule',  
-              self._curconfig['slot1_dl'],self._curconfig['slot1_ul'], \
-              self._curconfig['slot2_dl'],self._curconfig['slot2_ul'], \
-              self._curconfig['ssf_symbols_dl'],self._curconfig['ssf_symbols_gp'], \
-              self._curconfig['ssf_symbols_ul'],self._curconfig['tdd_blanking'])
-          self._kepler.call('tdd_sync_stop')
-          if self._kepler.call('center_freq') > 3e9:
-            try:
-              if self._curconfig['arfcn'] == 0:
-                if self._curconfig['rfbw'] == 999:
-                  self._kepler.call('tdd_sync_start_search',6,1)
-                else:
-                  self._kepler.call('tdd_sync_start_search',6,1, self._curconfig['center_freq']*1e6 - self._curconfig['rfbw']*1e6/2, self._curconfig['center_freq']*1e6 + self._curconfig['rfbw']*1e6/2)
-              else:
-                self._kepler.call('tdd_sync_start_search_arfcn',6,1,self._curconfig['arfcn'])
-            except:
-              pass
-
-    if 'center_freq' in newconfig.keys() and newconfig['center_freq'] != self._curconfig['center_freq']:
-      self._curconfig['center_freq'] = newconfig['center_freq']
-      prev_pa = self._kepler.call('pa_enable')
-      prev_mode = self._kepler.call('mode')
-      self._kepler.call('gain', -30)
-      self._kepler.call('pa_enable', 0, 0)
-      self._kepler.call('mode', 0, 0)
-      self._kepler.call('tuner_reset')
-      self._kepler.call('center_freq', self._curconfig['center_freq']*1e6)
-      self._kepler.call('mode', *prev_mode)
-      self._kepler.call('pa_enable', *prev_pa)
-      self._kepler.call('tdd_sync_stop')
-      try:
-        if self._curconfig['arfcn'] == 0:
-          if self._curconfig['rfbw'] == 999:
-            self._kepler.call('tdd_sync_start_search',6,1)
-          else:
-            self._kepler.call('tdd_sync_start_search',6,1, self._curconfig['center_freq']*1e6 - self._curconfig['rfbw']*1e6/2, self._curconfig['center_freq']*1e6 + self._curconfig['rfbw']*1e6/2)
-        else:
-          self._kepler.call('tdd_sync_start_search_arfcn',6,1,self._curconfig['arfcn'])
-      except:
-        pass
-
-    if 'canx_on' in newconfig.keys() or 'agc_on' in newconfig.keys():
-      if newconfig['canx_on'] != self._curconfig['canx_on'] or newconfig['agc_on'] != self._curconfig['agc_on']:
-        self._curconfig['canx_on'] = newconfig['canx_on']
-        self._curconfig['agc_on'] = newconfig['agc_on']
-        self._kepler.call('mode', self._curconfig['canx_on'], self._curconfig['agc_on'])
-        self._kepler.call('tuner_reset')
-
-    if 'rpt_on' in newconfig.keys() and newconfig['rpt_on'] != self._curconfig['rpt_on']:
-      self._curconfig['rpt_on'] = newconfig['rpt_on']
-      if self._curconfig['rpt_on'] == 0:
-        self._prev_mode = self._kepler.call('mode')
-        self._kepler.call('mode', 0, 0)
-        self._kepler.call('gain', self.MIN_DIG_GAIN)
-        self._kepler.call('pa_enable', 0, 0)
-      if self._curconfig['rpt_on'] == 1:
+      if k in cur and not k.startswith('chan_fir_'):
+        desired[k] = v if k in ['center_freq', 'tdd_blanking'] else int(v)
+    changed = set(k for k in desired if desired[k] != cur.get(k))
+    plan = []
+
+    if changed & set(['dl_rx_1', 'dl_rx_2']):
+      logger.info('DL Atten RX : %s/%s -> %s/%s', cur['dl_rx_1'], cur['dl_rx_2'], desired['dl_rx_1'], desired['dl_rx_2'])
+      plan.append(('dl_atten', (100, 100, desired['dl_rx_1'], desired['dl_rx_2'])))
+    if changed & set(['ul_rx_1', 'ul_rx_2']):
+      logger.info('UL Atten RX : %s/%s -> %s/%s', cur['ul_rx_1'], cur['ul_rx_2'], desired['ul_rx_1'], desired['ul_rx_2'])
+      plan.append(('ul_atten', (100, 100, desired['ul_rx_1'], desired['ul_rx_2'])))
+
+    if 'tdd_mode' in changed:
+      logger.info('TDD Mode : %s -> %s', cur['tdd_mode'], desired['tdd_mode'])
+      if desired['tdd_mode'] == 1:
+        # HW TDD
+        plan.append(('tdd_mode', (0, 1)))
+      elif desired['tdd_mode'] == 2:
+        # DL only
+        plan.append(('tdd_mode', (1, 0)))
+      elif desired['tdd_mode'] == 3:
+        # UL only
+        plan.append(('tdd_mode', (1, 1)))
+      else:
+        raise RuntimeError('????')
+
+    if 'lowgain_mode' in changed:
+      logger.info('LowGain Mode : %s -> %s', cur['lowgain_mode'], desired['lowgain_mode'])
+      if desired['lowgain_mode'] == 1:
+        # Lowgain Mode OFF
+        plan.append(('tuner_lowgain_mode', (0,)))
+      elif desired['lowgain_mode'] == 2:
+        # Lowgain Mode ON
+        plan.append(('tuner_lowgain_mode', (1,)))
+      else:
+        raise RuntimeError('????')
+
+    if 'rfbw' in changed:
+      if desired['rfbw'] == 999:
+        plan.append(('bypass_chan_fir', (1,)))
+      else:
+        plan.append(('bypass_chan_fir', (0,)))
+        plan.append(('chan_fir_bank_sel', (self._bw_values.index(desired['rfbw']),)))
+    self._set_rfbw_fields(desired)
+
+    if changed & set(self.SCHEDULE_KEYS):
+      for item in self.SCHEDULE_KEYS:
+        logger.info('%s : %s -> %s', item, cur[item], desired[item])
+      schedule = [desired[item] for item in self.SCHEDULE_KEYS]
+      logger.debug("tdd_blanking : %s, len %d", desired['tdd_blanking'], len(desired['tdd_blanking']))
+      plan.append(('tdd_frame_schedule', tuple(schedule if len(desired['tdd_blanking']) > 0 else schedule[:-1])))
+
+    if 'center_freq' in changed:
+      plan.append(lambda: self._retune(desired['center_freq']))
+
+    # one sync restart covers bandwidth, schedule, arfcn and frequency changes
+    sync_keys = set(self.SCHEDULE_KEYS + ['arfcn'])
+    if changed & (sync_keys | set(['rfbw', 'center_freq'])):
+      plan.append(self._acq.cancel)
+      plan.append(('tdd_sync_stop', ()))
+      if changed & set(['rfbw', 'center_freq']) or desired['center_freq']*1e6 > 3e9:
+        plan.append(lambda: self._acq.start(desired))
+
+    if changed & set(['canx_on', 'agc_on']):
+      plan.append(('mode', (desired['canx_on'], desired['agc_on'])))
+      plan.append(('tuner_reset', ()))
+
+    if 'rpt_on' in changed:
+      if desired['rpt_on'] == 0:
+        plan.append(self._repeater_off)
+      if desired['rpt_on'] == 1:
         if self._prev_mode != None:
-          self._curconfig['canx_on'] = self._prev_mode[0]
-          self._curconfig['agc_on'] = self._prev_mode[1]
-        self._kepler.call('pa_enable', 1, 1)
-        self._kepler.call('mode', self._curconfig['canx_on'], self._curconfig['agc_on'])
-        self._prev_mode = None
-
-    boxcal_data = self._kepler.call('get_boxcal_data')
-    dl_atten = self._kepler.call('dl_atten')
-    ul_atten = self._kepler.call('ul_atten')
-    donorrx_dbm2dbfs = (boxcal_data[8] - np.array(dl_atten[2:4])/4) + boxcal_data[0:2]
-    donortx_dbfs2dbm = boxcal_data[2:4]
-    serverrx_dbm2dbfs = (boxcal_data[9] - np.array(ul_atten[2:4])/4) + boxcal_data[4:6]
-    servertx_dbfs2dbm = boxcal_data[6:8]
-    analog_gain = max(np.add(donorrx_dbm2dbfs, servertx_dbfs2dbm))
+          desired['canx_on'] = self._prev_mode[0]
+          desired['agc_on'] = self._prev_mode[1]
+        plan.append(lambda: self._repeater_on(desired['canx_on'], desired['agc_on']))
+
+    if changed & set(['dl_rx_1', 'dl_rx_2', 'ul_rx_1', 'ul_rx_2']):
+      plan.append(self._update_analog_gain)
+
+    if 'target_gain' in changed:
+      logger.info('Target Gain : %s -> %s', cur['target_gain'], desired['target_gain'])
+      plan.append(lambda: self._set_target_gain(desired['target_gain']))
+
+    return plan, desired
+
+  def run_plan(self, plan):
+    """Execute a plan from plan_config, consecutive register writes go out as one batch."""
+    batch = []
+    for step in plan + [None]:
+      if callable(step) or step is None:
+        if batch:
+          self._kepler.call_many(batch)
+          batch = []
+        if step is not None:
+          step()
+      else:
+        batch.append(step)
+
+  def change_config(self, newconfig):
+    """Apply newconfig as a diff against the current config, returns the plan that ran."""
+    plan, desired = self.plan_config(newconfig)
+    self.run_plan(plan)
+    self._curconfig.update(desired)
+    self.save_config()
+    return plan
+
+  def wait_sync(self, timeout, interval=SYNC_POLL_INTERVAL):
+    """Poll tdd_sync_status until the search settles or timeout expires, returns the last status."""
+    deadline = time.monotonic() + timeout
+    while True:
+      stat = self._kepler.call('tdd_sync_status')
+      if stat[0] != 1 or time.monotonic() + interval > deadline:
+        return stat
+      time.sleep(interval)
+
+  def _update_analog_gain(self):
+    conv = boxcal_conversions(*self._kepler.call_many([('get_boxcal_data',), ('dl_atten',), ('ul_atten',)]))
+    analog_gain = max(conv['donorrx_dbm2dbfs'] + conv['servertx_dbfs2dbm'])
     self._analog_gain = analog_gain
-    print("analog gain = {}".format(analog_gain))
+    logger.info("analog gain = %s", analog_gain)
 
-    self._curconfig['dl_rx_1'] = dl_atten[2]
-    self._curconfig['dl_rx_2'] = dl_atten[3]
-    self._curconfig['ul_rx_1'] = ul_atten[2]
-    self._curconfig['ul_rx_2'] = ul_atten[3]
+  def _retune(self, center_freq):
+    prev_pa, prev_mode = self._kepler.call_many([('pa_enable',), ('mode',)])
+    self._kepler.call_many([
+      ('gain', (-30,)), ('pa_enable', (0, 0)), ('mode', (0, 0)), ('tuner_reset', ()),
+      ('center_freq', (center_freq*1e6,)), ('mode', tuple(prev_mode)), ('pa_enable', tuple(prev_pa))])
 
-    if 'target_gain' in newconfig.keys() and newconfig['target_gain'] != self._curconfig['target_gain']:
-      print('Target Gain : {} -> {}'.format(self._curconfig['target_gain'], newconfig['target_gain']))
-      self._curconfig['target_gain'] = int(newconfig['target_gain'])
-#print('Change config : target gain {}'.format(self._curconfig['target_gain']))
-      rpt_mode = self._kepler.call('mode')
-      if rpt_mode[1] == 0:
-        # manual gain
-        self._kepler.call('gain', self._curconfig['target_gain'] - self._analog_gain)
-        self._kepler.call('dac_fr_accum_reset')
-      else:
-        # auto gain
-        rpt_params = self._kepler.call('repeater_params')
-        rpt_params[0] = self._curconfig['target_gain'] - self._analog_gain
-        self._kepler.call('repeater_params', *rpt_params)
-    self.save_config()  
+  def _repeater_off(self):
+    self._prev_mode = self._kepler.call('mode')
+    self._kepler.call_many([('mode', (0, 0)), ('gain', (self.MIN_DIG_GAIN,)), ('pa_enable', (0, 0))])
+
+  def _repeater_on(self, canx_on, agc_on):
+    self._kepler.call_many([('pa_enable', (1, 1)), ('mode', (canx_on, agc_on))])
+    self._prev_mode = None
+
+  def _set_target_gain(self, target_gain):
+    rpt_mode = self._kepler.call('mode')
+    if rpt_mode[1] == 0:
+      # manual gain
+      self._kepler.call_many([('gain', (target_gain - self._analog_gain,)), ('dac_fr_accum_reset', ())])
+    else:
+      # auto gain
+      rpt_params = self._kepler.call('repeater_params')
+      rpt_params[0] = target_gain - self._analog_gain
+      self._kepler.call('repeater_params', *rpt_params)
 
   def save_config(self):
-    with open(self._savefile, 'wb') as f:
-      pickle.dump(self._curconfig, f, protocol=pickle.HIGHEST_PROTOCOL)
-      os.sync()
+    # written behind, bursts of changes end up in one write
+    self._config_store.save(self._curconfig)
 
   def load_config(self):
-    if not os.path.exists(self._savefile):
-      return None
-    with open(self._savefile, 'rb') as f:
-      saved_config = pickle.load(f)
-    return saved_config
+    # the config read from the module is the rollback base on a fresh install
+    return self._config_store.load(default=self._curconfig)
+
+  def config_journal(self):
+    return self._config_store.journal()
+
+  def rollback_config(self, steps=1):
+    """Re-apply the config as it was steps changes ago, the rollback is journaled as a change too."""
+    return self.change_config(self._config_store.rollback_target(steps))
  
-  def get_kepler_status(self):
-    return self._kstat_h, self._kstat_v
+  def get_status(self):
+    """Copy of the numeric status vector, STATUS_LAYOUT fields."""
+    return self._status.copy()
 
-  def get_tdd_status(self):
-    return self._tstat_h, self._tstat_v
+  def get_kepler_status(self, status=None):
+    """Headers and display strings, rendered from status (default: the current one) on first access."""
+    return self._kstat_h, LazyStatus(render_kepler_status, self.get_status() if status is None else status)
+
+  def get_tdd_status(self, status=None):
+    return self._tstat_h, LazyStatus(render_tdd_status, self.get_status() if status is None else status)
+
+  def get_history(self, start=None, end=None, points=None, fields=None):
+    return self._history.query(start, end, points, fields)
+
+  def get_journal(self, start=None, end=None, limit=None):
+    if self._journal is None:
+      return None
+    return self._journal.read(start, end, limit)
 
   def fetch_tdd_status(self):
 #    rf_status = self._kepler.call('rf_status')
@@ -378,91 +382,49 @@ class Repeater():
 #    self._tstat_v['band'] = 'n' + str(stat['band'])
 #    self._tstat_v['arfcn'] = self._curconfig['arfcn']
     stat = self._kepler.call('tdd_sync_status')
-    self._tstat_v['status'] = 'OK' if stat[0] == 2 else 'SEARCHING' if stat[0] == 1 else 'IDLE'
-    self._tstat_v['cellid'] = str(stat[2])
-    self._tstat_v['ssrssi'] = '{:.1f}'.format(stat[4] - self._donorrx_dbm2dbfs)
-    self._tstat_v['lastdetected'] = '{:.1f}'.format(stat[5])
-    self._tstat_v['lindex'] = str(stat[3])
-    self._tstat_v['scs'] = '30'
-    self._tstat_v['arfcn'] = str(stat[1])
-
-  def check_alive(self):
-    uptime = self._kepler.call('secs_alive')
-    if uptime < self._prev_uptime:
-      print("!!!!!!!!!!!!!! Module rebooted !?!? Re-initializing the module..")
+    set_status(self._status, sync_state=stat[0], arfcn=stat[1], cellid=stat[2], lindex=stat[3],
+               ssrssi=stat[4] - self._donorrx_dbm2dbfs, lastdetected=stat[5])
+
+  def check_alive(self, timeout=None):
+    """Read the module uptime, True when it rebooted (or a failed re-init is pending) since the last check."""
+    uptime = self._kepler.call('secs_alive', timeout=timeout)
+    with self.lock:
+      rebooted = uptime < self._prev_uptime or self._needs_init
+      self._prev_uptime = uptime
+    return rebooted
+
+  def reinit(self):
+    """Re-initialize after a module reboot, called by the watchdog."""
+    with self.lock:
+      self._needs_init = True
+      self._kepler.invalidate_cache()
       self.init()
-    self._prev_uptime = uptime
+      self._needs_init = False
 
   def fetch_kepler_status(self):
-    self._kepler.call('dac_fr_accum_reset')
-#    tdd_module_status = self._tdd.read_status_simple()
-    delchan_pwrs = self._kepler.call('get_delchan_pwrs')
-    fullchan_pwrs = self._kepler.call('get_fullchan_pwrs')
-    current_gain = self._kepler.call('gain')
-#    rf_status = self._kepler.call('rf_status')
-    accum_status = self._kepler.call('accum_status')
-    adcdac_pwrs = self._kepler.call('read_powers')
-    boxcal_data = self._kepler.call('get_boxcal_data')
-    center_freq = self._kepler.call('center_freq')/1e6
-    tdd_mode = self._kepler.call('tdd_mode')
-    lowgain_mode = self._kepler.call('tuner_lowgain_mode')
-    canx_mode = self._kepler.call('mode')
-
-    dl_atten = self._kepler.call('dl_atten')
-    ul_atten = self._kepler.call('ul_atten')
-    donorrx_dbm2dbfs = (boxcal_data[8] - np.array(dl_atten[2:4])/4) + boxcal_data[0:2]
-    self._donorrx_dbm2dbfs = donorrx_dbm2dbfs[0]
-    donortx_dbfs2dbm = boxcal_data[2:4]
-    serverrx_dbm2dbfs = (boxcal_data[9] - np.array(ul_atten[2:4])/4) + boxcal_data[4:6]
-    servertx_dbfs2dbm = boxcal_data[6:8]
-    analog_gain = max(np.add(donorrx_dbm2dbfs, servertx_dbfs2dbm))
+    (_, delchan_pwrs, fullchan_pwrs, current_gain, accum_status, adcdac_pwrs, boxcal_data,
+     center_freq, tdd_mode, lowgain_mode, canx_mode, dl_atten, ul_atten, pa_en) = self._kepler.call_many([
+      ('dac_fr_accum_reset',), ('get_delchan_pwrs',), ('get_fullchan_pwrs',), ('gain',),
+      ('accum_status',), ('read_powers',), ('get_boxcal_data',), ('center_freq',), ('tdd_mode',),
+      ('tuner_lowgain_mode',), ('mode',), ('dl_atten',), ('ul_atten',), ('pa_enable',)])
+    center_freq = center_freq/1e6
+
+    conv = boxcal_conversions(boxcal_data, dl_atten, ul_atten)
+    self._donorrx_dbm2dbfs = conv['donorrx_dbm2dbfs'][0]
+    analog_gain = max(conv['donorrx_dbm2dbfs'] + conv['servertx_dbfs2dbm'])
     self._analog_gain = analog_gain
 
-    dl_tx_pwr = np.add(adcdac_pwrs[12:14], servertx_dbfs2dbm)
-    dl_rx_pwr = np.subtract(adcdac_pwrs[20:22], donorrx_dbm2dbfs)
-    dl_echo_pwr = np.subtract(adcdac_pwrs[16:18], donorrx_dbm2dbfs)
-    ul_tx_pwr = np.add(adcdac_pwrs[14:16], donortx_dbfs2dbm)
-    ul_rx_pwr = np.subtract(adcdac_pwrs[22:24], serverrx_dbm2dbfs)
-    ul_echo_pwr = np.subtract(adcdac_pwrs[18:20], serverrx_dbm2dbfs)
-
-    pa_en = self._kepler.call('pa_enable')
     rpt_on = 1 if pa_en[0] > 0 or pa_en[1] > 0 else 0 
 
-    self._kstat_v['gain'] = 'OFF' if rpt_on == 0 else '{:.1f}'.format(analog_gain + current_gain) if accum_status[1] == 0 else '{:.1f} OSC!'.format(analog_gain + current_gain - 12.)
-    self._kstat_v['center_freq'] = '{:.3f}'.format(center_freq)
-    self._kstat_v['tdd_mode'] = 'Auto' if tdd_mode[0] == 0 else 'DL Only' if tdd_mode[1] == 0 else 'UL Only'
-    self._kstat_v['lowgain_mode'] = 'OFF' if lowgain_mode == 0 else 'ON'
-    self._kstat_v['agc_on'] = '-' if self._curconfig['rpt_on'] == 0 else ('Auto' if canx_mode[1] == 1 else 'Manual')
-    self._kstat_v['canx_on'] = '-' if self._curconfig['rpt_on'] == 0 else ('ON' if canx_mode[0] == 1 else 'OFF')
-    self._kstat_v['dltxpwr'] = ' / '.join('{:.1f}'.format(k) for k in dl_tx_pwr)
-    self._kstat_v['dlrxpwr'] = ' / '.join('{:.1f}'.format(k) for k in dl_rx_pwr)
-    self._kstat_v['dlechopwr'] = ' / '.join('{:.1f}'.format(k) for k in dl_echo_pwr)
-    self._kstat_v['ultxpwr'] = ' / '.join('{:.1f}'.format(k) for k in ul_tx_pwr)
-    self._kstat_v['ulrxpwr'] = ' / '.join('{:.1f}'.format(k) for k in ul_rx_pwr)
-    self._kstat_v['ulechopwr'] = ' / '.join('{:.1f}'.format(k) for k in ul_echo_pwr)
-
-    isol_offset_dl = [-servertx_dbfs2dbm[0]-donorrx_dbm2dbfs[0], -servertx_dbfs2dbm[0]-donorrx_dbm2dbfs[1], -servertx_dbfs2dbm[1]-donorrx_dbm2dbfs[0], -servertx_dbfs2dbm[1]-donorrx_dbm2dbfs[1]]
-    isol_offset_dl = np.add(isol_offset_dl, 10.)
-#    isol_offset_ul = [-donortx_dbfs2dbm[0]-serverrx_dbm2dbfs[0], -donortx_dbfs2dbm[0]-serverrx_dbm2dbfs[1], -donortx_dbfs2dbm[1]-serverrx_dbm2dbfs[0], -donortx_dbfs2dbm[1]-serverrx_dbm2dbfs[1]]
-#    isol_offset_ul = np.add(isol_offset_ul, 10.)
-    pre_isol_dl = np.add(fullchan_pwrs[0:4], isol_offset_dl)
-#    pre_isol_ul = np.add(fullchan_pwrs[4:8], isol_offset_ul)
-    post_isol_dl = np.add(delchan_pwrs[0:4], isol_offset_dl)
-#    post_isol_ul = np.add(delchan_pwrs[4:8], isol_offset_ul)
-
-    self._kstat_v['preisol'] = '{:.1f}  ({:.1f} / {:.1f} / {:.1f} / {:.1f})'.format(max(pre_isol_dl), *pre_isol_dl)
-    self._kstat_v['postisol'] = '{:.1f}  ({:.1f} / {:.1f} / {:.1f} / {:.1f})'.format(max(post_isol_dl), *post_isol_dl)
-    self._kstat_v['dacpwr'] = 'DL {:.1f} / {:.1f}   UL {:.1f} / {:.1f}'.format(*adcdac_pwrs[0:4])
-    self._kstat_v['dacpwr_max'] = 'DL {:.1f} / {:.1f}   UL {:.1f} / {:.1f}'.format(*adcdac_pwrs[12:16])
-    self._kstat_v['adcpwr'] = 'DL {:.1f} / {:.1f}   UL {:.1f} / {:.1f}'.format(*adcdac_pwrs[4:8])
-    self._kstat_v['adcpwr_max'] = 'DL {:.1f} / {:.1f}   UL {:.1f} / {:.1f}'.format(*adcdac_pwrs[16:20])
-    
-    str_tm = str(datetime.timedelta(seconds=self._prev_uptime))
-    if ',' in str_tm:
-        day = str_tm.split(',')[0]
-        hour, minute, second = str_tm.split(',')[1].split(':')
-    else:
-        day = ''
-        hour, minute, second = str_tm.split(':')
-
-    self._kstat_v['uptime'] = '{}{} hour {} min {} sec'.format(day, hour, minute, int(float(second)))
+    now = time.time()
+    self._history.append(now, read_powers=adcdac_pwrs, fullchan_pwrs=fullchan_pwrs,
+                         delchan_pwrs=delchan_pwrs, gain=analog_gain + current_gain)
+    if self._journal is not None:
+      flags = (FLAG_OSC if accum_status[1] != 0 else 0) | (FLAG_RPT_ON if rpt_on else 0)
+      self._journal.append(now, flags, read_powers=adcdac_pwrs, fullchan_pwrs=fullchan_pwrs,
+                           delchan_pwrs=delchan_pwrs, gain=analog_gain + current_gain)
+
+    set_power_status(self._status, adcdac_pwrs, fullchan_pwrs, delchan_pwrs, conv)
+    set_status(self._status, gain=analog_gain + current_gain, osc=accum_status[1] != 0, pa_on=rpt_on,
+               rpt_on=self._curconfig['rpt_on'], center_freq=center_freq, tdd_mode=tdd_mode[:2],
+               lowgain_mode=lowgain_mode, mode=canx_mode[:2], uptime=self._prev_uptime)
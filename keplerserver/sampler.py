@@ -0,0 +1,99 @@
+import collections
+import logging
+import threading
+import time
+import types
+
+logger = logging.getLogger(__name__)
+
+# immutable view of the repeater status, published by StatusSampler
+StatusSnapshot = collections.namedtuple('StatusSnapshot',
+    ['seq', 'timestamp', 'kstat_h', 'kstat', 'tstat_h', 'tstat', 'config', 'status'])
+
+class StatusSampler():
+  """Background thread owning the refresh of the Repeater status.
+
+  Requests read the latest snapshot instead of talking to the module, so the
+  serial load stays the same no matter how many clients are watching.
+  """
+
+  def __init__(self, rpt, interval=1.0, config_every=10, gate=None):
+    self._rpt = rpt
+    # periodic samples are skipped while gate() is false (e.g. module not up)
+    self._gate = gate
+    self._interval = interval
+    self._config_every = config_every
+    self._seq = 0
+    self._snapshot = None
+    self._cond = threading.Condition()
+    self._wake = threading.Event()
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    if self._thread is not None:
+      return
+    # publish what Repeater.init() already fetched, no RPCs needed
+    self._publish()
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, name='status-sampler', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    self._wake.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def snapshot(self):
+    with self._cond:
+      return self._snapshot
+
+  def wait_newer(self, seq, timeout=None):
+    """Block until a snapshot newer than seq is published, returns the latest snapshot."""
+    with self._cond:
+      self._cond.wait_for(lambda: self._snapshot is not None and self._snapshot.seq > seq, timeout)
+      return self._snapshot
+
+  def refresh(self, config=False):
+    """Sample synchronously (e.g. right after a config change) and return the new snapshot."""
+    return self.sample(config=config)
+
+  def sample(self, config=False):
+    with self._rpt.lock:
+      self._rpt.fetch_kepler_status()
+      self._rpt.fetch_tdd_status()
+      if config:
+        self._rpt.fetch_curconfig()
+    return self._publish()
+
+  def _publish(self):
+    with self._rpt.lock:
+      status = self._rpt.get_status()
+      status.flags.writeable = False
+      # display strings are rendered from the vector only if someone reads them
+      kstat_h, kstat_v = self._rpt.get_kepler_status(status)
+      tstat_h, tstat_v = self._rpt.get_tdd_status(status)
+      config = types.MappingProxyType(dict(self._rpt.get_config()))
+      kstat_h, tstat_h = types.MappingProxyType(dict(kstat_h)), types.MappingProxyType(dict(tstat_h))
+    with self._cond:
+      self._seq += 1
+      self._snapshot = StatusSnapshot(self._seq, time.time(), kstat_h, kstat_v, tstat_h, tstat_v, config, status)
+      self._cond.notify_all()
+      return self._snapshot
+
+  def _run(self):
+    count = 0
+    while not self._stop.is_set():
+      self._wake.wait(self._interval)
+      self._wake.clear()
+      if self._stop.is_set():
+        break
+      if self._gate is not None and not self._gate():
+        continue
+      count += 1
+      try:
+        self.sample(config=(self._config_every > 0 and count % self._config_every == 0))
+      except Exception as e:
+        logger.warning("status sample failed : %s", e)
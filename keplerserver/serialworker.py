@@ -0,0 +1,116 @@
+import itertools
+import queue
+import threading
+
+# request priorities, lower runs first
+PRIO_CONTROL = 0   # config writes, resets
+PRIO_CAPTURE = 1   # captures and waveform/tap transfers
+PRIO_STATUS = 2    # status polls
+
+class SerialTimeout(RuntimeError):
+  pass
+
+class SerialBusy(SerialTimeout):
+  """Timed out still queued behind other requests, the module was never asked."""
+  pass
+
+class SerialCancelled(RuntimeError):
+  pass
+
+class SerialRequest():
+
+  def __init__(self, fn, priority):
+    self._fn = fn
+    self.priority = priority
+    self._done = threading.Event()
+    self._state_lock = threading.Lock()
+    self._started = False
+    self._cancelled = False
+    self._result = None
+    self._error = None
+
+  def cancel(self):
+    """Drop the request if the worker has not picked it up yet, returns True on success."""
+    with self._state_lock:
+      if self._started:
+        return False
+      self._cancelled = True
+    self._error = SerialCancelled('request cancelled')
+    self._done.set()
+    return True
+
+  def cancelled(self):
+    return self._cancelled
+
+  def done(self):
+    return self._done.is_set()
+
+  def result(self, timeout=None):
+    """Wait for the request, cancelling it on timeout if it is still queued."""
+    if not self._done.wait(timeout):
+      if self.cancel():
+        raise SerialBusy('request timed out after {} s in queue'.format(timeout))
+      raise SerialTimeout('request timed out after {} s on the link'.format(timeout))
+    if self._error is not None:
+      raise self._error
+    return self._result
+
+  def _execute(self):
+    with self._state_lock:
+      if self._cancelled:
+        return
+      self._started = True
+    try:
+      self._result = self._fn()
+    except Exception as e:
+      self._error = e
+    self._done.set()
+
+class SerialWorker():
+  """Single thread owning the serial link.
+
+  Every KeplerRPC transaction is run here, so any number of HTTP threads can
+  submit work without interleaving frames on the UART. Requests are served
+  by priority, FIFO within the same priority.
+  """
+
+  def __init__(self, name='serial-worker'):
+    self._name = name
+    self._queue = queue.PriorityQueue()
+    self._seq = itertools.count()
+    self._thread = None
+
+  def start(self):
+    if self._thread is not None:
+      return
+    self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    if self._thread is None:
+      return
+    self._queue.put((-1, next(self._seq), None))
+    self._thread.join()
+    self._thread = None
+
+  def queue_depth(self):
+    return self._queue.qsize()
+
+  def submit(self, fn, priority=PRIO_STATUS):
+    req = SerialRequest(fn, priority)
+    if threading.current_thread() is self._thread:
+      # nested call from a job already running on the link
+      req._execute()
+    else:
+      self._queue.put((priority, next(self._seq), req))
+    return req
+
+  def run(self, fn, priority=PRIO_STATUS, timeout=None):
+    return self.submit(fn, priority).result(timeout)
+
+  def _run(self):
+    while True:
+      _, _, req = self._queue.get()
+      if req is None:
+        break
+      req._execute()
@@ -0,0 +1,176 @@
+import threading
+import time
+import numpy as np
+
+# serial link cost model of the real module, per call and per payload byte (s)
+SIM_CALL_LATENCY = 0.005
+SIM_BYTE_LATENCY = 0.
+
+class SimKeplerRPC():
+  """Stand-in for KeplerRPC answering the methods Repeater and the routes use.
+
+  Getters return the simulated register state, calls with arguments write
+  it. Every call costs latency + per_byte * payload bytes, so the server can
+  be exercised and benchmarked without the module.
+  """
+
+  def __init__(self, port='sim', latency=SIM_CALL_LATENCY, per_byte=SIM_BYTE_LATENCY, seed=0):
+    self._port = port
+    self.latency = latency
+    self.per_byte = per_byte
+    self.calls = 0
+    self._rng = np.random.default_rng(seed)
+    self._lock = threading.Lock()
+    self._boot = time.monotonic()
+    self._cell_arfcn = 630000
+    self._sync_state = 0
+    self._sync_started = 0.
+    self._sync_time = 0.
+    self._sync_arfcn = 0
+    self._pilot = b''
+    self._canxfir = {}
+    self._regs = {
+      'vendor': 1,
+      'center_freq': 3.6e9,
+      'gain': 10.,
+      'mode': [1, 1],
+      'repeater_params': [10., 1, 0, 0],
+      'pa_enable': [1, 1],
+      'dl_atten': [100, 100, 8, 8],
+      'ul_atten': [100, 100, 8, 8],
+      'tdd_mode': [0, 0],
+      'tuner_lowgain_mode': 0,
+      'bypass_chan_fir': 0,
+      'chan_fir_bank_sel': 6,
+      'tdd_sync_search_freq': [0, 3.58e9, 3.62e9, 30000],
+      'tdd_frame_schedule': [7, 2, 0, 0, 6, 4, 4, ''],
+      'get_boxcal_data': [-10., -10., 30., 30., -10., -10., 30., 30., -20., -20.],
+      'accum_status': [0, 0],
+      'pilot_enable': 0,
+    }
+
+  def _sleep(self, nbytes=0):
+    t = self.latency + self.per_byte * nbytes
+    if t > 0:
+      time.sleep(t)
+
+  def _sync_status(self):
+    if self._sync_state == 1 and time.monotonic() - self._sync_started >= self._sync_time:
+      if self._sync_arfcn in [0, self._cell_arfcn]:
+        self._sync_state = 2
+    locked = self._sync_state == 2
+    return [self._sync_state, self._cell_arfcn if locked else 0, 101 if locked else 0, 3 if locked else 0,
+            -60. + self._rng.normal(0, 0.5), 10. if locked else 0.]
+
+  def _start_search(self, arfcn, duration):
+    self._sync_state = 1
+    self._sync_started = time.monotonic()
+    self._sync_arfcn = arfcn
+    self._sync_time = duration
+
+  def call(self, method, *args):
+    nbytes = sum(len(memoryview(a).cast('B')) for a in args if isinstance(a, (bytes, bytearray, memoryview)))
+    with self._lock:
+      self.calls += 1
+      ret = self._dispatch(method, args)
+    if isinstance(ret, bytes):
+      nbytes += len(ret)
+    self._sleep(nbytes)
+    return ret
+
+  def call_many(self, calls):
+    """Pipelined batch of (method, args) requests, one round-trip for the whole batch.
+
+    A request that fails puts its exception in the reply list, the ones
+    before it have reached the module.
+    """
+    nbytes = 0
+    replies = []
+    with self._lock:
+      for method, args in calls:
+        nbytes += sum(len(memoryview(a).cast('B')) for a in args if isinstance(a, (bytes, bytearray, memoryview)))
+        self.calls += 1
+        try:
+          ret = self._dispatch(method, tuple(args))
+        except Exception as e:
+          ret = e
+        if isinstance(ret, bytes):
+          nbytes += len(ret)
+        replies.append(ret)
+    self._sleep(nbytes)
+    return replies
+
+  def call_noreply(self, method, *args):
+    with self._lock:
+      self.calls += 1
+      if method == 'bootloader':
+        self._boot = time.monotonic()
+    self._sleep()
+
+  def _dispatch(self, method, args):
+    if method == 'pa_enabled':
+      method = 'pa_enable'
+    if method == 'secs_alive':
+      return time.monotonic() - self._boot
+    if method == 'tdd_sync_status':
+      return self._sync_status()
+    if method == 'tdd_sync_stop':
+      self._sync_state = 0
+      return 0
+    if method == 'tdd_sync_start_search':
+      self._start_search(0, 2.)
+      self._regs['tdd_sync_search_freq'] = [0] + list(args[2:4] or [3.3e9, 3.8e9]) + [30000]
+      return 0
+    if method == 'tdd_sync_start_search_arfcn':
+      self._start_search(args[2], 0.3)
+      self._regs['tdd_sync_search_freq'] = [args[2], 0, 0, 0]
+      return 0
+    if method == 'read_powers':
+      return list(np.round(np.linspace(-30., -10., 24) + self._rng.normal(0, 0.3, 24), 2))
+    if method == 'get_fullchan_pwrs':
+      return list(np.round(-40. + self._rng.normal(0, 0.3, 8), 2))
+    if method == 'get_delchan_pwrs':
+      return list(np.round(-60. + self._rng.normal(0, 0.3, 8), 2))
+    if method in ['dac_fr_accum_reset', 'tuner_reset']:
+      return 0
+    if method == 'read_capture':
+      group, length, triggered = args
+      return self._rng.integers(-2048, 2048, 2 * length, dtype='int16').tobytes()
+    if method == 'load_pilot':
+      self._pilot = bytes(args[0])
+      return len(self._pilot) // 4
+    if method == 'canxfir_load':
+      self._canxfir[args[0]] = bytes(args[1])
+      return 0
+    if method == 'canxfir_get':
+      return self._canxfir.get(args[0], np.zeros(64, dtype='float32').tobytes())
+    if method not in self._regs:
+      raise RuntimeError('sim: unknown method {}'.format(method))
+    if not args:
+      val = self._regs[method]
+      return list(val) if isinstance(val, list) else val
+    if method == 'tdd_frame_schedule':
+      args = tuple(args) + ('',) * (8 - len(args))
+    self._regs[method] = list(args) if isinstance(self._regs[method], list) else args[0]
+    return 0
+
+class SimGPIO():
+  """RPi.GPIO stand-in, records the last level written per pin."""
+
+  BCM = 11
+  OUT = 0
+  IN = 1
+
+  def __init__(self):
+    self.levels = {}
+
+  def setmode(self, mode):
+    pass
+
+  def setup(self, pin, direction):
+    pass
+
+  def output(self, pin, level):
+    self.levels[pin] = level
+
+sim_gpio = SimGPIO()
@@ -0,0 +1,162 @@
+import collections.abc
+import datetime
+import threading
+import numpy as np
+
+from .history import layout_fields
+
+# field layout of the numeric status vector, (field, width); powers in dBm,
+# module levels in dBFS, isolation in dB, center_freq in MHz, uptime in s
+STATUS_LAYOUT = [
+  ('gain', 1),
+  ('osc', 1),
+  ('pa_on', 1),
+  ('rpt_on', 1),
+  ('center_freq', 1),
+  ('tdd_mode', 2),
+  ('lowgain_mode', 1),
+  ('mode', 2),
+  ('dl_tx_pwr', 2),
+  ('dl_rx_pwr', 2),
+  ('dl_echo_pwr', 2),
+  ('ul_tx_pwr', 2),
+  ('ul_rx_pwr', 2),
+  ('ul_echo_pwr', 2),
+  ('pre_isol', 4),
+  ('post_isol', 4),
+  ('dac_pwr', 4),
+  ('adc_pwr', 4),
+  ('dac_pwr_max', 4),
+  ('adc_pwr_max', 4),
+  ('uptime', 1),
+  ('sync_state', 1),
+  ('arfcn', 1),
+  ('cellid', 1),
+  ('lindex', 1),
+  ('ssrssi', 1),
+  ('lastdetected', 1),
+]
+
+STATUS_FIELDS, STATUS_WIDTH = layout_fields(STATUS_LAYOUT)
+
+# the power fields (dl_tx_pwr .. adc_pwr_max) are one contiguous block gathered
+# from read_powers (24) + fullchan_pwrs (8) + delchan_pwrs (8)
+_POWER_BLOCK = slice(STATUS_FIELDS['dl_tx_pwr'].start, STATUS_FIELDS['adc_pwr_max'].stop)
+_POWER_INDEX = np.array([12, 13, 20, 21, 16, 17, 14, 15, 22, 23, 18, 19] +
+                        list(range(24, 28)) + list(range(32, 36)) +
+                        list(range(0, 8)) + list(range(12, 20)))
+
+def new_status():
+  # float64, the display strings round exactly like the float64 math they replaced
+  return np.full(STATUS_WIDTH, np.nan, dtype='float64')
+
+def set_status(vec, **fields):
+  """Write STATUS_LAYOUT fields into vec in place."""
+  for name, values in fields.items():
+    vec[STATUS_FIELDS[name]] = values
+
+def set_power_status(vec, read_powers, fullchan_pwrs, delchan_pwrs, conv):
+  """Fill the power block of vec in one gather + add from the raw registers.
+
+  conv are the boxcal conversions (analysis.boxcal_conversions).
+  """
+  src = np.concatenate([read_powers[:24], fullchan_pwrs[:8], delchan_pwrs[:8]]).astype('float64')
+  rx_d, rx_s = conv['donorrx_dbm2dbfs'], conv['serverrx_dbm2dbfs']
+  tx_d, tx_s = conv['donortx_dbfs2dbm'], conv['servertx_dbfs2dbm']
+  # same association as the per-field sums, so results match to the last bit
+  isol = (-tx_s[[0, 0, 1, 1]] - rx_d[[0, 1, 0, 1]]) + 10.
+  # -0. leaves the raw levels untouched, +0. would turn a -0.0 reading into 0.0
+  offsets = np.concatenate([tx_s, -rx_d, -rx_d, tx_d, -rx_s, -rx_s, isol, isol, np.full(16, -0.)])
+  vec[_POWER_BLOCK] = src[_POWER_INDEX] + offsets
+
+def status_dict(vec):
+  """name -> float or list of floats, for JSON."""
+  # drop float64 sum noise, so -26.87 is not sent as -26.870000000000005
+  values = np.round(vec, 6).tolist()
+  return {name: (values[sl][0] if sl.stop - sl.start == 1 else values[sl])
+          for name, sl in STATUS_FIELDS.items()}
+
+def _pair(v):
+  return ' / '.join('{:.1f}'.format(k) for k in v)
+
+def _levels(v):
+  return 'DL {:.1f} / {:.1f}   UL {:.1f} / {:.1f}'.format(*v)
+
+def _int(v):
+  return '-' if np.isnan(v) else str(int(v))
+
+def _uptime(secs):
+  if np.isnan(secs):
+    return '-'
+  str_tm = str(datetime.timedelta(seconds=float(secs)))
+  if ',' in str_tm:
+    day = str_tm.split(',')[0]
+    hour, minute, second = str_tm.split(',')[1].split(':')
+  else:
+    day = ''
+    hour, minute, second = str_tm.split(':')
+  return '{}{} hour {} min {} sec'.format(day, hour, minute, int(float(second)))
+
+def render_kepler_status(vec):
+  """Display strings of the Kepler status table."""
+  f = {name: vec[sl] for name, sl in STATUS_FIELDS.items()}
+  gain = f['gain'][0]
+  rpt_on = f['rpt_on'][0] != 0
+  return {
+    'gain': 'OFF' if f['pa_on'][0] == 0 else '{:.1f}'.format(gain) if f['osc'][0] == 0 else '{:.1f} OSC!'.format(gain - 12.),
+    'center_freq': '{:.3f}'.format(f['center_freq'][0]),
+    'tdd_mode': 'Auto' if f['tdd_mode'][0] == 0 else 'DL Only' if f['tdd_mode'][1] == 0 else 'UL Only',
+    'lowgain_mode': 'OFF' if f['lowgain_mode'][0] == 0 else 'ON',
+    'agc_on': '-' if not rpt_on else ('Auto' if f['mode'][1] == 1 else 'Manual'),
+    'canx_on': '-' if not rpt_on else ('ON' if f['mode'][0] == 1 else 'OFF'),
+    'dltxpwr': _pair(f['dl_tx_pwr']),
+    'dlrxpwr': _pair(f['dl_rx_pwr']),
+    'dlechopwr': _pair(f['dl_echo_pwr']),
+    'ultxpwr': _pair(f['ul_tx_pwr']),
+    'ulrxpwr': _pair(f['ul_rx_pwr']),
+    'ulechopwr': _pair(f['ul_echo_pwr']),
+    'preisol': '{:.1f}  ({:.1f} / {:.1f} / {:.1f} / {:.1f})'.format(max(f['pre_isol']), *f['pre_isol']),
+    'postisol': '{:.1f}  ({:.1f} / {:.1f} / {:.1f} / {:.1f})'.format(max(f['post_isol']), *f['post_isol']),
+    'dacpwr': _levels(f['dac_pwr']),
+    'dacpwr_max': _levels(f['dac_pwr_max']),
+    'adcpwr': _levels(f['adc_pwr']),
+    'adcpwr_max': _levels(f['adc_pwr_max']),
+    'uptime': _uptime(f['uptime'][0]),
+  }
+
+def render_tdd_status(vec):
+  """Display strings of the TDD sync status table."""
+  f = {name: vec[sl][0] for name, sl in STATUS_FIELDS.items() if sl.stop - sl.start == 1}
+  return {
+    'status': 'OK' if f['sync_state'] == 2 else 'SEARCHING' if f['sync_state'] == 1 else 'IDLE',
+    'cellid': _int(f['cellid']),
+    'ssrssi': '{:.1f}'.format(f['ssrssi']),
+    'lastdetected': '{:.1f}'.format(f['lastdetected']),
+    'lindex': _int(f['lindex']),
+    'scs': '30',
+    'arfcn': _int(f['arfcn']),
+  }
+
+class LazyStatus(collections.abc.Mapping):
+  """Read-only mapping of display strings, rendered from a status vector on first access."""
+
+  def __init__(self, render, vec):
+    self._render = render
+    self._vec = vec
+    self._values = None
+    self._lock = threading.Lock()
+
+  def _get(self):
+    with self._lock:
+      if self._values is None:
+        self._values = self._render(self._vec)
+      return self._values
+
+  def __getitem__(self, key):
+    return self._get()[key]
+
+  def __iter__(self):
+    return iter(self._get())
+
+  def __len__(self):
+    return len(self._get())
@@ -0,0 +1,167 @@
+import atexit
+import collections
+import copy
+import hashlib
+import logging
+import threading
+import time
+import msgpack
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TRACE_FORMAT = 'kepler-trace'
+TRACE_VERSION = 1
+
+# one record per KeplerRPC call, after a header map
+TraceRecord = collections.namedtuple('TraceRecord', ['t', 'method', 'args', 'ret', 'latency', 'error'])
+
+def _pack_default(obj):
+  if isinstance(obj, (bytearray, memoryview)):
+    return bytes(obj)
+  if isinstance(obj, np.generic):
+    return obj.item()
+  if isinstance(obj, np.ndarray):
+    return obj.tolist()
+  if isinstance(obj, tuple):
+    return list(obj)
+  raise TypeError('{} is not serializable in a trace'.format(type(obj).__name__))
+
+class TraceWriter():
+  """Appends KeplerRPC calls to a msgpack-framed trace file.
+
+  The file is a header map followed by one [t, method, args, ret, latency,
+  error] array per call, t and latency in seconds, t relative to the header.
+  Records are buffered, close() (or flush()) makes them durable.
+  """
+
+  def __init__(self, path, port=None):
+    self.path = path
+    self._packer = msgpack.Packer(use_bin_type=True, default=_pack_default)
+    self._lock = threading.Lock()
+    self._f = open(path, 'wb')
+    self._t0 = time.time()
+    self._mono0 = time.monotonic()
+    self.records = 0
+    self._f.write(self._packer.pack({'format': TRACE_FORMAT, 'version': TRACE_VERSION, 'started': self._t0,
+                                     'port': port}))
+    atexit.register(self.close)
+
+  def record(self, method, args, ret, latency, error=None, t=None):
+    """t is the time.monotonic() the call started, now - latency if omitted."""
+    if t is None:
+      t = time.monotonic() - latency
+    if isinstance(ret, Exception):
+      ret, error = None, ret
+    rec = [t - self._mono0, method, list(args), ret, latency, None if error is None else str(error)]
+    with self._lock:
+      if self._f is None:
+        return
+      try:
+        data = self._packer.pack(rec)
+      except TypeError as e:
+        logger.warning('trace: %s reply not recorded : %s', method, e)
+        rec[3] = None
+        data = self._packer.pack(rec)
+      self._f.write(data)
+      self.records += 1
+
+  def record_seed(self, method, args, ret, latency):
+    """Record a reply seen before the trace started, at t=0."""
+    self.record(method, args, ret, latency, t=self._mono0)
+
+  def flush(self):
+    with self._lock:
+      if self._f is not None:
+        self._f.flush()
+
+  def close(self):
+    with self._lock:
+      if self._f is not None:
+        self._f.close()
+        self._f = None
+
+def read_trace(path):
+  """Return (header, list of TraceRecord) from a trace file."""
+  with open(path, 'rb') as f:
+    unpacker = msgpack.Unpacker(f, raw=False, use_list=True, max_buffer_size=0)
+    header = next(unpacker, None)
+    if not isinstance(header, dict) or header.get('format') != TRACE_FORMAT:
+      raise ValueError('{}: not a Kepler trace'.format(path))
+    if header.get('version') != TRACE_VERSION:
+      raise ValueError('{}: unsupported trace version {}'.format(path, header.get('version')))
+    return header, [TraceRecord(*rec) for rec in unpacker]
+
+def _argkey(args):
+  # hashable stand-in for call arguments, payloads by length and digest
+  key = []
+  for a in args:
+    if isinstance(a, (bytes, bytearray, memoryview)):
+      a = bytes(a)
+      key.append(('bytes', len(a), hashlib.sha1(a).hexdigest()))
+    elif isinstance(a, (list, tuple, np.ndarray)):
+      key.append(_argkey(list(a)))
+    elif isinstance(a, np.generic):
+      key.append(a.item())
+    else:
+      key.append(a)
+  return tuple(key)
+
+class ReplayKeplerRPC():
+  """KeplerRPC stand-in serving replies from a recorded trace, pass it to Kepler as cli.
+
+  Calls are matched on method and arguments and the recorded replies for
+  each are served in order, the last one repeats once they run out. A call
+  never seen with these arguments gets the last reply of the same method,
+  a method missing from the trace gets None (what setters return) and is
+  logged once. With timing > 0 each reply is delayed by its recorded
+  latency times timing.
+  """
+
+  def __init__(self, path, port='replay', timing=0.):
+    self.port = port
+    self.header, records = read_trace(path)
+    self._timing = timing
+    self._lock = threading.Lock()
+    self._replies = {}
+    self._by_method = {}
+    for rec in records:
+      self._replies.setdefault((rec.method, _argkey(rec.args)), collections.deque()).append(rec)
+      self._by_method[rec.method] = rec
+    self._unknown = set()
+    self.calls = 0
+    self.misses = 0
+    logger.info('replaying %d calls from %s', len(records), path)
+
+  def _next(self, method, args):
+    with self._lock:
+      self.calls += 1
+      queue = self._replies.get((method, _argkey(args)))
+      if queue:
+        return queue.popleft() if len(queue) > 1 else queue[0]
+      self.misses += 1
+      rec = self._by_method.get(method)
+      if rec is None:
+        first = method not in self._unknown
+        self._unknown.add(method)
+    if rec is None:
+      if first:
+        logger.warning('replay: %s not in the trace, answering None', method)
+      return None
+    logger.debug('replay: %s%s not recorded, using the reply to %s', method, tuple(args), tuple(rec.args))
+    return rec
+
+  def call(self, method, *args):
+    rec = self._next(method, args)
+    if rec is None:
+      return None
+    if self._timing > 0:
+      time.sleep(rec.latency * self._timing)
+    if rec.error is not None:
+      raise RuntimeError(rec.error)
+    # a reply may be served again, callers must not change the recorded one
+    return copy.deepcopy(rec.ret)
+
+  def call_noreply(self, method, *args):
+    if self._timing > 0:
+      time.sleep(0.001 * self._timing)
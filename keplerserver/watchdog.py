@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+
+from .serialworker import SerialBusy, SerialCancelled
+
+logger = logging.getLogger(__name__)
+
+HEALTH_UP = 'up'
+HEALTH_REBOOTING = 'rebooting'
+HEALTH_REINITIALIZING = 'reinitializing'
+HEALTH_UNREACHABLE = 'unreachable'
+
+class Watchdog():
+  """Heartbeat thread owning the module liveness checks.
+
+  Samples secs_alive every interval seconds. Uptime going backwards means
+  the module rebooted, the Repeater is then re-initialized on this thread,
+  never on a request thread. After max_failures failed heartbeats in a row
+  the module is unreachable and polling backs off up to max_backoff
+  seconds. A heartbeat that times out still queued behind other requests
+  is skipped, not counted as a failure. Requests read health() without any serial I/O.
+  """
+
+  def __init__(self, rpt, interval=2.0, timeout=2.0, max_failures=3, max_backoff=30.):
+    self._rpt = rpt
+    self._interval = interval
+    self._timeout = timeout
+    self._max_failures = max_failures
+    self._max_backoff = max_backoff
+    self._lock = threading.Lock()
+    self._state = HEALTH_UP
+    self._since = time.time()
+    self._failures = 0
+    self._reboots = 0
+    self._last_ok = None
+    self._last_error = None
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    if self._thread is not None:
+      return
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, name='watchdog', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  @property
+  def state(self):
+    return self._state
+
+  def is_up(self):
+    return self._state == HEALTH_UP
+
+  def health(self):
+    with self._lock:
+      return {'state': self._state, 'since': self._since, 'last_ok': self._last_ok, 'failures': self._failures,
+              'reboots': self._reboots, 'error': self._last_error}
+
+  def _set_state(self, state):
+    with self._lock:
+      if state == self._state:
+        return
+      logger.info('module health %s -> %s', self._state, state)
+      self._state = state
+      self._since = time.time()
+
+  def beat(self):
+    """One heartbeat, returns the delay before the next one."""
+    try:
+      rebooted = self._rpt.check_alive(timeout=self._timeout)
+    except (SerialBusy, SerialCancelled) as e:
+      # the link is busy (a long capture or batch), not a sign the module is gone
+      logger.debug('heartbeat skipped : %s', e)
+      return self._interval
+    except Exception as e:
+      with self._lock:
+        self._failures += 1
+        self._last_error = str(e)
+        failures = self._failures
+      if failures >= self._max_failures:
+        if self._state != HEALTH_UNREACHABLE:
+          logger.warning('module unreachable after %d failed heartbeats : %s', failures, e)
+        self._set_state(HEALTH_UNREACHABLE)
+      return min(self._max_backoff, self._interval * 2 ** max(0, failures - self._max_failures + 1))
+    with self._lock:
+      self._failures = 0
+      self._last_error = None
+      self._last_ok = time.time()
+    if rebooted:
+      with self._lock:
+        self._reboots += 1
+      self._set_state(HEALTH_REBOOTING)
+      self._reinit()
+    else:
+      self._set_state(HEALTH_UP)
+    return self._interval
+
+  def _reinit(self):
+    logger.warning('module rebooted (uptime went backwards), re-initializing the module..')
+    self._set_state(HEALTH_REINITIALIZING)
+    try:
+      self._rpt.reinit()
+    except Exception as e:
+      logger.exception('re-initialization failed')
+      with self._lock:
+        self._last_error = str(e)
+      # check_alive keeps reporting the reboot until reinit succeeds
+      return
+    self._set_state(HEALTH_UP)
+
+  def _run(self):
+    delay = self._interval
+    while not self._stop.wait(delay):
+      delay = self.beat()
@@ -0,0 +1,4 @@
+import os
+
+# the package imports RPi.GPIO unless it runs against the simulated module
+os.environ.setdefault('KEPLERSERVER_SIM', '1')
@@ -0,0 +1,78 @@
+import json
+import pickle
+import time
+
+import pytest
+
+from keplerserver.configstore import CONFIG_FORMAT_VERSION, ConfigStore
+
+DEFAULT = {'center_freq': 3600., 'target_gain': 60., 'rfbw': 40}
+
+def _store(tmp_path, **kwargs):
+  return ConfigStore(str(tmp_path / 'config.json'), legacy_path=str(tmp_path / 'config.cfg'), **kwargs)
+
+def _read(tmp_path):
+  with open(str(tmp_path / 'config.json')) as f:
+    return json.load(f)
+
+def test_saves_within_delay_are_one_write(tmp_path):
+  store = _store(tmp_path, delay=0.05)
+  store.load(default=DEFAULT)
+  for gain in range(61, 66):
+    store.save(dict(DEFAULT, target_gain=float(gain)))
+  assert store.writes == 0
+  time.sleep(0.3)
+  assert store.writes == 1
+  assert _read(tmp_path)['config']['target_gain'] == 65.
+  assert len(_read(tmp_path)['journal']) == 5
+
+def test_unchanged_config_is_not_written(tmp_path):
+  store = _store(tmp_path, delay=10.)
+  store.load(default=DEFAULT)
+  store.save(DEFAULT)
+  store.flush()
+  assert store.writes == 0
+
+def test_first_change_after_a_fresh_install_rolls_back(tmp_path):
+  store = _store(tmp_path, delay=10.)
+  assert store.load(default=DEFAULT) is None
+  store.save(dict(DEFAULT, target_gain=70.))
+  assert store.rollback_target(1) == DEFAULT
+
+def test_journal_survives_a_restart(tmp_path):
+  store = _store(tmp_path, delay=10.)
+  store.load(default=DEFAULT)
+  store.save(dict(DEFAULT, target_gain=70.))
+  store.save(dict(DEFAULT, target_gain=70., rfbw=100))
+  store.flush()
+
+  store = _store(tmp_path, delay=10.)
+  assert store.load(default={'ignored': 1}) == dict(DEFAULT, target_gain=70., rfbw=100)
+  assert store.rollback_target(1) == dict(DEFAULT, target_gain=70.)
+  assert store.rollback_target(2) == DEFAULT
+  with pytest.raises(ValueError):
+    store.rollback_target(3)
+
+def test_journal_is_capped(tmp_path):
+  store = _store(tmp_path, delay=10., journal_len=3)
+  store.load(default=DEFAULT)
+  for gain in range(61, 71):
+    store.save(dict(DEFAULT, target_gain=float(gain)))
+  assert [entry['changes']['target_gain'] for entry in store.journal()] == [[67., 68.], [68., 69.], [69., 70.]]
+
+def test_legacy_pickle_is_migrated(tmp_path):
+  with open(str(tmp_path / 'config.cfg'), 'wb') as f:
+    pickle.dump(DEFAULT, f)
+  store = _store(tmp_path, delay=10.)
+  assert store.load() == DEFAULT
+  store.save(dict(DEFAULT, rfbw=20))
+  store.flush()
+  data = _read(tmp_path)
+  assert data['version'] == CONFIG_FORMAT_VERSION
+  assert data['config']['rfbw'] == 20
+
+def test_unknown_version_is_refused(tmp_path):
+  with open(str(tmp_path / 'config.json'), 'w') as f:
+    json.dump({'version': CONFIG_FORMAT_VERSION + 1, 'config': DEFAULT}, f)
+  with pytest.raises(ValueError):
+    _store(tmp_path).load()
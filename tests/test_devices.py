@@ -0,0 +1,36 @@
+import json
+import os
+
+import pytest
+
+import keplerserver
+from keplerserver.devices import DeviceRegistry
+
+@pytest.fixture
+def registry(monkeypatch):
+  registry = DeviceRegistry()
+  monkeypatch.setattr(keplerserver, '_devices', registry)
+  return registry
+
+def _load(monkeypatch, tmp_path, devices):
+  path = None
+  if devices is not None:
+    path = str(tmp_path / 'devices.json')
+    with open(path, 'w') as f:
+      json.dump({'devices': devices}, f)
+  monkeypatch.setattr(keplerserver, 'devices_config', path)
+  keplerserver.load_devices()
+
+def test_built_in_unit_has_a_journal(monkeypatch, tmp_path, registry):
+  _load(monkeypatch, tmp_path, None)
+  assert [(d.id, d.journal_dir) for d in registry] == [('kepler0', keplerserver.telemetry_journal_dir)]
+
+def test_single_configured_unit_has_a_journal(monkeypatch, tmp_path, registry):
+  _load(monkeypatch, tmp_path, [{'id': 'unit-a', 'port': '/dev/ttyUSB1'}])
+  assert [(d.id, d.journal_dir) for d in registry] == [('unit-a', keplerserver.telemetry_journal_dir)]
+
+def test_several_units_get_their_own_paths(monkeypatch, tmp_path, registry):
+  _load(monkeypatch, tmp_path, [{'id': 'unit-a', 'port': '/dev/ttyUSB1'}, {'id': 'unit-b', 'port': '/dev/ttyUSB2'}])
+  assert [d.journal_dir for d in registry] == [os.path.join(keplerserver.telemetry_journal_dir, 'unit-a'),
+                                               os.path.join(keplerserver.telemetry_journal_dir, 'unit-b')]
+  assert len({d.savefile for d in registry}) == 2
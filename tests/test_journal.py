@@ -0,0 +1,90 @@
+import glob
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from keplerserver.journal import JOURNAL_HEADER, JournalTooLarge, TelemetryJournal
+
+# the package's /api/journal route shadows the module attribute
+journal_module = sys.modules[TelemetryJournal.__module__]
+
+def _segments(directory):
+  return sorted(glob.glob(os.path.join(directory, 'telemetry-*.kjl')))
+
+def _fill(journal, times):
+  for t in times:
+    journal.append(t, 0, gain=[t])
+
+def test_restart_continues_the_last_segment(tmp_path):
+  journal = TelemetryJournal(str(tmp_path), segment_records=10)
+  _fill(journal, [1., 2., 3.])
+  journal.close()
+
+  journal = TelemetryJournal(str(tmp_path), segment_records=10)
+  _fill(journal, [4., 5.])
+  assert len(_segments(str(tmp_path))) == 1
+  assert journal.read()['t'].tolist() == [1., 2., 3., 4., 5.]
+
+def test_restarts_do_not_rotate_history_out(tmp_path):
+  for i in range(10):
+    journal = TelemetryJournal(str(tmp_path), segment_records=100, max_segments=2)
+    _fill(journal, [float(i)])
+    journal.close()
+  assert journal.read()['t'].tolist() == [float(i) for i in range(10)]
+
+def test_full_segment_rotates_on_restart(tmp_path):
+  journal = TelemetryJournal(str(tmp_path), segment_records=4)
+  _fill(journal, [1., 2., 3., 4.])
+  journal.close()
+
+  journal = TelemetryJournal(str(tmp_path), segment_records=4)
+  _fill(journal, [5.])
+  assert len(_segments(str(tmp_path))) == 2
+  assert journal.read()['t'].tolist() == [1., 2., 3., 4., 5.]
+
+def test_other_version_is_not_appended_to(tmp_path):
+  journal = TelemetryJournal(str(tmp_path), segment_records=10)
+  _fill(journal, [1.])
+  journal.close()
+  path = _segments(str(tmp_path))[0]
+  with open(path, 'r+b') as f:
+    header = np.fromfile(f, dtype=JOURNAL_HEADER, count=1)
+    header['version'] = 99
+    f.seek(0)
+    header.tofile(f)
+
+  journal = TelemetryJournal(str(tmp_path), segment_records=10)
+  _fill(journal, [2.])
+  assert len(_segments(str(tmp_path))) == 2
+  assert journal.read()['t'].tolist() == [2.]
+
+def test_windowed_read_across_segments(tmp_path):
+  journal = TelemetryJournal(str(tmp_path), segment_records=4, max_segments=3)
+  _fill(journal, [float(t) for t in range(1, 13)])
+  assert len(_segments(str(tmp_path))) == 3
+  records = journal.read(3.5, 9.)
+  assert records['t'].tolist() == [4., 5., 6., 7., 8., 9.]
+  assert records['data'][:, -1].tolist() == [4., 5., 6., 7., 8., 9.]
+  assert journal.read(20., 30.)['t'].tolist() == []
+
+  _fill(journal, [13.])
+  # the oldest segment went with the rotation
+  assert journal.read()['t'][0] == 5.
+
+def test_read_limit(tmp_path):
+  journal = TelemetryJournal(str(tmp_path), segment_records=4)
+  _fill(journal, [float(t) for t in range(1, 9)])
+  with pytest.raises(JournalTooLarge):
+    journal.read(limit=7)
+  assert len(journal.read(5., None, limit=7)) == 4
+
+def test_segments_outside_the_window_are_not_mapped(tmp_path, monkeypatch):
+  journal = TelemetryJournal(str(tmp_path), segment_records=4)
+  _fill(journal, [float(t) for t in range(1, 13)])
+  opened = []
+  segment = journal_module.JournalSegment
+  monkeypatch.setattr(journal_module, 'JournalSegment', lambda path: opened.append(path) or segment(path))
+  assert journal.read(5., 6.)['t'].tolist() == [5., 6.]
+  assert opened == [_segments(str(tmp_path))[1]]
@@ -0,0 +1,60 @@
+import json
+
+import numpy as np
+import pytest
+
+import keplerserver
+from keplerserver.devices import Device, DeviceRegistry
+from keplerserver.sim import SimKeplerRPC
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+  registry = DeviceRegistry()
+  monkeypatch.setattr(keplerserver, '_devices', registry)
+  device = registry.add(Device('kepler0', 'sim', savefile=str(tmp_path / 'config.json'),
+                               make_cli=lambda port: SimKeplerRPC(port, latency=0.)))
+  device.start(0.1)
+  yield keplerserver.app.test_client()
+  device.sampler.stop()
+  device.watchdog.stop()
+
+def _taps(value):
+  return np.full(64, value, dtype='<f4').tobytes()
+
+def test_canxfir_etag(client):
+  resp = client.get('/api/kepler/canxfir_get,0')
+  assert resp.status_code == 200
+  etag, version = resp.headers['ETag'], int(resp.headers['X-Canxfir-Version'])
+
+  resp = client.get('/api/kepler/canxfir_get,0', headers={'If-None-Match': etag})
+  assert resp.status_code == 304
+  assert resp.headers['ETag'] == etag
+
+  resp = client.post('/api/kepler/canxfir_load_raw,0', data=_taps(0.5), content_type='application/octet-stream')
+  assert resp.status_code == 200
+  resp = client.get('/api/kepler/canxfir_get,0', headers={'If-None-Match': etag})
+  assert resp.status_code == 200
+  assert resp.headers['ETag'] != etag
+  assert int(resp.headers['X-Canxfir-Version']) > version
+
+def test_canxfir_etag_of_another_slot_is_kept(client):
+  etag = client.get('/api/kepler/canxfir_get,1').headers['ETag']
+  client.post('/api/kepler/canxfir_load_raw,0', data=_taps(0.25), content_type='application/octet-stream')
+  assert client.get('/api/kepler/canxfir_get,1', headers={'If-None-Match': etag}).status_code == 304
+
+def test_batch_reads_its_own_writes(client):
+  before = client.get('/api/kepler/dl_atten').data.decode()
+  batch = [{'method': 'dl_atten'}, {'method': 'dl_atten', 'args': [100, 100, 5, 5]}, {'method': 'dl_atten'}]
+  resp = client.post('/api/kepler/batch', data=json.dumps(batch), content_type='application/json')
+  assert resp.status_code == 200
+  first, write, after = resp.get_json()
+  assert first['ok'] and write['ok'] and after['ok']
+  assert str(first['result']) == before
+  assert after['result'] == [100, 100, 5, 5]
+
+def test_batch_reports_bad_commands_per_entry(client):
+  batch = [{'method': 'gain'}, {'args': [1]}]
+  resp = client.post('/api/kepler/batch', data=json.dumps(batch), content_type='application/json')
+  assert resp.status_code == 200
+  good, bad = resp.get_json()
+  assert good['ok'] and not bad['ok']
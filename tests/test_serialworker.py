@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from keplerserver.serialworker import (PRIO_CAPTURE, PRIO_CONTROL, PRIO_STATUS, SerialBusy, SerialCancelled,
+                                       SerialTimeout, SerialWorker)
+
+@pytest.fixture
+def worker():
+  worker = SerialWorker()
+  worker.start()
+  yield worker
+  worker.stop()
+
+def _block(worker):
+  # occupy the link until the returned event is set
+  started, release = threading.Event(), threading.Event()
+  worker.submit(lambda: started.set() or release.wait(5.), PRIO_CONTROL)
+  assert started.wait(5.)
+  return release
+
+def test_priority_then_fifo(worker):
+  release = _block(worker)
+  order = []
+  reqs = [worker.submit(lambda tag=tag: order.append(tag), prio) for tag, prio in
+          [('status1', PRIO_STATUS), ('capture', PRIO_CAPTURE), ('status2', PRIO_STATUS), ('control', PRIO_CONTROL)]]
+  assert worker.queue_depth() == 4
+  release.set()
+  for req in reqs:
+    req.result(5.)
+  assert order == ['control', 'capture', 'status1', 'status2']
+
+def test_result_and_error(worker):
+  assert worker.run(lambda: 42) == 42
+  with pytest.raises(ZeroDivisionError):
+    worker.run(lambda: 1 / 0)
+
+def test_queued_timeout_is_busy_and_never_runs(worker):
+  release = _block(worker)
+  ran = []
+  with pytest.raises(SerialBusy):
+    worker.run(lambda: ran.append(1), PRIO_STATUS, timeout=0.05)
+  release.set()
+  worker.run(lambda: None, timeout=5.)
+  assert ran == []
+
+def test_timeout_on_the_link_is_not_busy(worker):
+  release = threading.Event()
+  with pytest.raises(SerialTimeout) as e:
+    worker.run(lambda: release.wait(5.), timeout=0.05)
+  assert not isinstance(e.value, SerialBusy)
+  release.set()
+
+def test_cancel(worker):
+  release = _block(worker)
+  req = worker.submit(lambda: 1)
+  assert req.cancel()
+  release.set()
+  with pytest.raises(SerialCancelled):
+    req.result(5.)
+
+def test_running_request_is_not_cancelled(worker):
+  started, release = threading.Event(), threading.Event()
+  req = worker.submit(lambda: started.set() or release.wait(5.))
+  assert started.wait(5.)
+  assert not req.cancel()
+  release.set()
+  assert req.result(5.) is True
+
+def test_nested_call_runs_inline(worker):
+  assert worker.run(lambda: worker.run(lambda: 'inner', timeout=1.), timeout=5.) == 'inner'
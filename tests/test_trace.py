@@ -0,0 +1,63 @@
+import pytest
+
+from keplerserver.kepler import Kepler
+from keplerserver.repeater import Repeater
+from keplerserver.sim import SimKeplerRPC
+from keplerserver.trace import ReplayKeplerRPC, read_trace
+
+def _replay(path, tmp_path):
+  kepler = Kepler(port='replay', cli=ReplayKeplerRPC(path))
+  rpt = Repeater(kepler, savefile=str(tmp_path / 'replay' / 'config.json'))
+  return kepler, rpt
+
+@pytest.fixture
+def sim_kepler():
+  return Kepler(port='sim', cli=SimKeplerRPC(latency=0.))
+
+def test_replay_trace_recorded_from_start(tmp_path):
+  path = str(tmp_path / 'start.ktrace')
+  kepler = Kepler(port='sim', cli=SimKeplerRPC(latency=0.), trace=path)
+  rpt = Repeater(kepler, savefile=str(tmp_path / 'config.json'))
+  config = dict(rpt.get_config())
+  assert kepler.stop_trace() > 0
+
+  (tmp_path / 'replay').mkdir()
+  replay_kepler, replay_rpt = _replay(path, tmp_path)
+  assert replay_rpt.get_config() == config
+  assert replay_kepler.cli.misses == 0
+
+def test_replay_trace_started_at_runtime(tmp_path, sim_kepler):
+  rpt = Repeater(sim_kepler, savefile=str(tmp_path / 'config.json'))
+  config = dict(rpt.get_config())
+  path = str(tmp_path / 'runtime.ktrace')
+  sim_kepler.start_trace(path)
+  sim_kepler.call('secs_alive')
+  assert sim_kepler.stop_trace() > 1
+
+  header, records = read_trace(path)
+  methods = {rec.method for rec in records}
+  assert {'vendor', 'center_freq', 'gain', 'secs_alive'} <= methods
+
+  (tmp_path / 'replay').mkdir()
+  replay_kepler, replay_rpt = _replay(path, tmp_path)
+  assert replay_rpt.get_config() == config
+
+def test_seeds_leave_out_bulk_transfers(tmp_path, sim_kepler):
+  sim_kepler.call('vendor', 1)
+  sim_kepler.load_pilot_raw(bytes(64))
+  path = str(tmp_path / 'seeds.ktrace')
+  sim_kepler.start_trace(path)
+  sim_kepler.stop_trace()
+  header, records = read_trace(path)
+  assert [(rec.method, rec.args, rec.t) for rec in records if rec.method == 'vendor'] == [('vendor', [1], 0.)]
+  assert 'load_pilot' not in {rec.method for rec in records}
+
+def test_replay_answers_unknown_methods_with_none(tmp_path, sim_kepler):
+  path = str(tmp_path / 'small.ktrace')
+  sim_kepler.start_trace(path)
+  vendor = sim_kepler.call('vendor', 1)
+  sim_kepler.stop_trace()
+  replay = ReplayKeplerRPC(path)
+  assert replay.call('vendor', 1) == vendor
+  assert replay.call('tdd_sync_start_search_arfcn', 6, 1, 630000) is None
+  assert replay.misses == 1